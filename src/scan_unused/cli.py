@@ -1,33 +1,100 @@
-import os, argparse, operator, itertools, subprocess, pwd, datetime, logging
-from typing import Iterable, Tuple, Generator
+import os, sys, argparse, operator, datetime, logging, heapq, itertools, functools
+from typing import Dict, Iterable, List, Tuple, Generator
 
 import jinja2, tqdm
 
 import scan_unused
 from scan_unused.core import Node, Tree
-from scan_unused.utils import size_getter_str, get_atime_day_offset, get_deleting_path
+from scan_unused.compact import CompactTree
+from scan_unused.pipeline import Pipeline
+from scan_unused.owners import OwnerResolver
+from scan_unused.mail import SendmailBackend, SmtpBackend
+from scan_unused.stats import Stats
+from scan_unused.rules import Rules
+from scan_unused.walk import SCAN_BACKENDS
+from scan_unused import linux
+from scan_unused.utils import size_getter_str, get_atime_day_offset, get_deleting_path, get_days_ago_str
 
-def gen_email(template, tree: Node, nodes: Iterable[Node], owner: str, args) -> Tuple[str, Generator[str, None, None]]:
+class LargestNodes:
     '''
-    Convert warning parameters to email address and generator based on template.
+    Largest nodes of one owner up to limit, with the total size and count of every node added.
+    '''
+    __slots__ = ('limit', 'size', 'count', 'heap')
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.size = 0
+        self.count = 0
+        self.heap = []
+
+    def add(self, node: Node):
+        self.size += node.size
+        self.count += 1
+        # Count breaks ties so nodes themselves are never compared
+        item = (node.size, -self.count, node)
+        if len(self.heap) < self.limit: heapq.heappush(self.heap, item)
+        elif item > self.heap[0]: heapq.heapreplace(self.heap, item)
+
+    def get_nodes(self) -> List[Node]:
+        return [node for _, _, node in sorted(self.heap, reverse=True)]
+
+def group_largest(nodes: Iterable[Node], limit: int, groups: Dict[int, LargestNodes]=None) -> Dict[int, LargestNodes]:
+    '''
+    Group nodes by owner in a single pass, only holding on to the largest limit of each.
+    Given existing groups, nodes are added to them.
+    '''
+    groups = {} if groups is None else groups
+    for node in nodes:
+        group = groups.get(node.owner)
+        if group is None: group = groups[node.owner] = LargestNodes(limit)
+        group.add(node)
+    return groups
+
+@functools.lru_cache(maxsize=None)
+def load_template(path: str=None) -> jinja2.Template:
+    '''
+    Compile the user-provided or default email template once, shared by every email.
+    '''
+    template_paths = [f'{scan_unused.__path__[0]}/templates']
+    template_name = 'example.html'
+    if path:
+        template_paths.insert(0, os.path.dirname(os.path.abspath(os.path.expanduser(path))))
+        template_name = os.path.basename(path)
+    env = jinja2.Environment(trim_blocks=True, lstrip_blocks=True, auto_reload=False, loader=jinja2.FileSystemLoader(template_paths))
+    return env.get_template(template_name)
+
+def gen_email(template, dir: str, nodes: LargestNodes, owner: str, args) -> Tuple[str, Generator[str, None, None]]:
+    '''
+    Convert warning parameters for nodes found in dir to email address and generator based on template.
     '''
     data = {
         'owner': owner,
-        'nodes_dir': os.path.abspath(tree.root.name),
-        'nodes_size': size_getter_str(sum([x.size for x in nodes])),
-        'nodes_count': len(nodes),
-        'nodes': nodes,
+        'nodes_dir': os.path.abspath(dir),
+        'nodes_size': size_getter_str(nodes.size),
+        'nodes_count': nodes.count,
+        'nodes': nodes.get_nodes(),
         'args': args,
     }
     gen = template.generate(**data)
-    to = next(gen, None)
-    if to and to.startswith('To: '):
-        def _gen_full():
-            yield to
-            yield from gen
-        return to.split(':', 1)[1].strip(), _gen_full()
+    # The address may be rendered over several chunks, so read up to the end of the first line
+    head = ''
+    for chunk in gen:
+        head += chunk
+        if '\n' in head: break
+    if head.startswith('To: '):
+        return head.split('\n', 1)[0].split(':', 1)[1].strip(), itertools.chain([head], gen)
     raise Exception('Template must start with email headers i.e. To:')
 
+def _shard_spec(value: str) -> Tuple[int, int]:
+    index, _, count = value.partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid shard "{value}", expected I/N')
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f'invalid shard "{value}", I must be between 1 and N')
+    return index - 1, count
+
 def main():
     parser = argparse.ArgumentParser(
                 prog='scan-unused',
@@ -37,33 +104,167 @@ def main():
     parser.add_argument('--force', action='store_true', help='Force yes for confirmation (dangerous)')
     parser.add_argument('--email-domain', help='Send an email to each owner@domain about future deletions (modify template for more control)')
     parser.add_argument('--email-days', type=int, help='if provided, only mention files that will be deleted in this exact number of days')
-    parser.add_argument('--email-limit', type=int, default=50, help='limit number of paths in emails')
-    parser.add_argument('--email-template', type=int, help='path to override jinja2 template')
+    parser.add_argument('--email-limit', type=int, default=50, help='limit number of paths in emails, largest first')
+    parser.add_argument('--email-template', help='path to override jinja2 template')
     parser.add_argument('--email-whitelist', nargs='+', help='limit users that can receive emails')
+    parser.add_argument('--email-backend', choices=['sendmail', 'smtp'], default='sendmail', help='deliver with sendmail processes or one reused SMTP connection (default sendmail)')
+    parser.add_argument('--email-workers', type=int, default=4, help='number of sendmail processes running at once (default 4)')
+    parser.add_argument('--smtp-host', default='localhost:25', help='SMTP server as host[:port] for --email-backend smtp (default localhost:25)')
+    parser.add_argument('--email-from', help='envelope sender for --email-backend smtp (default user@hostname)')
     parser.add_argument('--dryrun', action='store_true', help='Print files/emails that would have been deleted/sent')
+    parser.add_argument('--forecast-days', metavar='N', type=int, help='report what will be deleted on each of the next N days, per owner')
+    parser.add_argument('--report', choices=['owners'], help='print usage per owner, including how much is unused or expires tomorrow')
+    parser.add_argument('--stream', action='store_true', help='delete while scanning without holding the tree in memory (needs --force or --dryrun, no emails/reports/snapshots)')
+    parser.add_argument('--pipeline', action='store_true', help='delete each top-level entry as soon as it has been scanned while scanning the rest, then send emails (needs --force or --dryrun)')
+    parser.add_argument('--workers', type=int, default=1, help='number of threads scanning/deleting directories in parallel (default 1)')
+    parser.add_argument('--save-snapshot', metavar='PATH', help='save the scanned tree so later runs can reuse it with --load-snapshot')
+    parser.add_argument('--load-snapshot', metavar='PATH', help='reuse a tree saved with --save-snapshot instead of scanning')
+    parser.add_argument('--incremental', action='store_true', help='with --load-snapshot, rescan only directories changed since the snapshot')
+    parser.add_argument('--processes', type=int, default=1, help='number of processes each scanning a share of the top-level entries (default 1)')
+    parser.add_argument('--shard', metavar='I/N', type=_shard_spec, help='only scan share I of N of the top-level entries and save it with --save-snapshot, then exit')
+    parser.add_argument('--merge-snapshots', metavar='PATH', nargs='+', help='merge snapshots saved with --shard instead of scanning')
+    parser.add_argument('--scan-backend', choices=SCAN_BACKENDS, default='scandir', help='how directories are listed, statx reads in large batches and only asks for the fields needed (Linux only, default scandir)')
+    parser.add_argument('--rules', metavar='PATH', help='file of exclude/protect rules applied while scanning (see README)')
+    parser.add_argument('--profile', action='store_true', help='print time spent in each phase, counters and peak memory when finished')
+    parser.add_argument('--stats-json', metavar='PATH', help='write phase times, counters, email latency percentiles and peak memory to PATH as JSON')
     args = parser.parse_args()
 
+    stats = Stats()
+    try:
+        _run(parser, args, stats)
+    finally:
+        if args.profile: print(stats.format(), file=sys.stderr)
+        if args.stats_json: stats.write_json(args.stats_json)
+
+def _run(parser: argparse.ArgumentParser, args, stats: Stats):
     offset = get_atime_day_offset(args.directory)
     if offset:
         logging.warn(f'Directory "{args.directory}" mounted with relatime, days increased by {offset}')
         args.days += offset
 
+    if args.load_snapshot and args.merge_snapshots:
+        parser.error('--load-snapshot and --merge-snapshots cannot be used together')
+
+    rules = Rules.load(args.rules) if args.rules else None
+    if args.scan_backend == 'statx' and not linux.available():
+        parser.error('--scan-backend statx needs Linux with glibc 2.30 or later')
+
+    # Scan a single shard for merging elsewhere
+    if args.shard:
+        if not args.save_snapshot or args.load_snapshot or args.merge_snapshots or args.stream or args.pipeline:
+            parser.error('--shard needs --save-snapshot and only scans')
+        with stats.phase('scan'):
+            tree = CompactTree.from_dir(args.directory, args.workers, args.shard, stats, rules, args.scan_backend)
+        with stats.phase('save'):
+            tree.save(args.save_snapshot)
+        print(f'Saved shard {args.shard[0] + 1}/{args.shard[1]} to {args.save_snapshot}')
+        return
+
+    resolver = OwnerResolver()
+    def _with_owner(node):
+        return f'{node} [{resolver.get_name(node.owner, str(node.owner))}]'
+
+    # Delete while walking when nothing else needs the tree
+    if args.stream:
+        ignored = [flag for flag, value in (('--email-domain', args.email_domain), ('--forecast-days', args.forecast_days), ('--report', args.report),
+                                            ('--save-snapshot', args.save_snapshot), ('--load-snapshot', args.load_snapshot), ('--merge-snapshots', args.merge_snapshots),
+                                            ('--incremental', args.incremental), ('--processes', args.processes > 1), ('--pipeline', args.pipeline)) if value]
+        if ignored:
+            parser.error(f'--stream only supports deletion, not {", ".join(ignored)}')
+        if not (args.force or args.dryrun):
+            parser.error('--stream needs --force or --dryrun as deletions cannot be listed before confirming')
+        def _print_each(nodes):
+            # Walking happens as nodes are pulled, so it is timed apart from deleting them
+            nodes = iter(nodes)
+            while True:
+                with stats.phase('scan'):
+                    node = next(nodes, None)
+                if node is None: return
+                print(_with_owner(node))
+                yield node
+        deleting_path = get_deleting_path(args.directory) if not args.dryrun else os.path.join(args.directory, '.scan-unused-deleting')
+        nodes_to_delete = _print_each(Tree.stream_unused(args.directory, args.days, args.workers, os.path.basename(deleting_path), stats, rules, args.scan_backend))
+        if args.dryrun:
+            print('Would have deleted:')
+            for _ in nodes_to_delete: pass
+        else:
+            print('Deleting, do not interrupt...')
+            with stats.phase('delete'):
+                removed = Tree.delete_nodes(nodes_to_delete, deleting_path, args.workers, stats=stats)
+            print(f'Deleted {removed} entries')
+        return
+
+    # Delete each top-level entry while walking the next, collecting emails as they go
+    if args.pipeline:
+        ignored = [flag for flag, value in (('--forecast-days', args.forecast_days), ('--report', args.report), ('--save-snapshot', args.save_snapshot),
+                                            ('--load-snapshot', args.load_snapshot), ('--merge-snapshots', args.merge_snapshots), ('--incremental', args.incremental),
+                                            ('--processes', args.processes > 1)) if value]
+        if ignored:
+            parser.error(f'--pipeline only supports deletion and emails, not {", ".join(ignored)}')
+        if not (args.force or args.dryrun):
+            parser.error('--pipeline needs --force or --dryrun as deletions cannot be listed before confirming')
+        nodes_by_owner = {}
+        def _collect(subtree):
+            group_largest(subtree.iter_nodes_unused(args.days, args.email_days or 1), args.email_limit, nodes_by_owner)
+        def _act(nodes):
+            for node in nodes: print(_with_owner(node))
+            if args.dryrun: return 0
+            with stats.phase('delete'):
+                # Each batch removes the deleting folder once done
+                return Tree.delete_nodes(nodes, get_deleting_path(args.directory), args.workers, stats=stats)
+        print('Would have deleted:' if args.dryrun else 'Deleting, do not interrupt...')
+        pipeline = Pipeline(args.directory, args.days, _act, _collect if args.email_domain else None, args.workers, '.scan-unused-deleting',
+                            stats=stats, rules=rules, backend=args.scan_backend)
+        with stats.phase('pipeline'):
+            removed = pipeline.run()
+        if not args.dryrun: print(f'Deleted {removed} entries')
+        if args.email_domain:
+            _send_emails(args, args.directory, nodes_by_owner, resolver, stats)
+        return
+
     size_getter = operator.attrgetter('size')
-    owner_getter = operator.attrgetter('owner')
 
-    # Construct in-memory tree of all files/folders
-    tree = Tree.from_dir(args.directory)
+    # Construct in-memory tree of all files/folders, or map one from a previous scan
+    if args.load_snapshot or args.merge_snapshots:
+        with stats.phase('load'):
+            if args.load_snapshot:
+                tree = CompactTree.load(args.load_snapshot)
+            else:
+                tree = CompactTree.merge([CompactTree.load(path) for path in args.merge_snapshots])
+        if os.path.abspath(tree.root.name) != os.path.abspath(args.directory):
+            raise Exception(f'Snapshot "{args.load_snapshot or args.merge_snapshots[0]}" was not taken of "{args.directory}"')
+        print(f'Loaded snapshot taken {get_days_ago_str(tree.scan_time)} days ago')
+        if args.incremental:
+            with stats.phase('scan'):
+                tree = tree.rescan(args.workers, stats, rules, args.scan_backend)
+        elif rules:
+            # Snapshots are saved without protection
+            with stats.phase('load'):
+                tree.apply_rules(rules)
+    else:
+        with stats.phase('scan'):
+            if args.processes > 1:
+                tree = CompactTree.from_dir_sharded(args.directory, args.processes, args.workers, stats, rules, args.scan_backend)
+            else:
+                tree = CompactTree.from_dir(args.directory, args.workers, stats=stats, rules=rules, backend=args.scan_backend)
+    if args.save_snapshot:
+        with stats.phase('save'):
+            tree.save(args.save_snapshot)
+    with stats.phase('index'):
+        tree.build_index()
+    stats.add('nodes', len(tree))
 
     # Delete unused nodes
-    nodes_to_delete = list(tree.iter_nodes_unused(args.days))
+    with stats.phase('query'):
+        nodes_to_delete = list(tree.iter_nodes_unused(args.days))
     should_delete = args.force
     if args.dryrun:
         print('Would have deleted:')
-        print(*sorted(nodes_to_delete, key=size_getter, reverse=True), sep='\n')
+        print(*map(_with_owner, sorted(nodes_to_delete, key=size_getter, reverse=True)), sep='\n')
 
         print('\nRecently accessed files:')
         keep_files = list(tree.iter_nodes(lambda n: not n.is_folder and n.last_access >= (datetime.datetime.now() - datetime.timedelta(days=args.days)).timestamp()))
-        print(*sorted(keep_files, key=size_getter, reverse=True), sep='\n')
+        print(*map(_with_owner, sorted(keep_files, key=size_getter, reverse=True)), sep='\n')
     else:
         print('Deleting:')
         print(*sorted(nodes_to_delete, key=size_getter, reverse=True), sep='\n')
@@ -74,38 +275,73 @@ def main():
             if answer.lower() in ['yes']: should_delete = True
             elif answer.lower() in ['n', 'no']: break
 
+        if should_delete and (args.load_snapshot or args.merge_snapshots):
+            # Snapshot atimes may be stale, even after --incremental which keeps those of unchanged directories, so check again before deleting
+            to_t = (datetime.datetime.now() - datetime.timedelta(days=args.days)).timestamp()
+            with stats.phase('verify'):
+                nodes_to_delete = list(Tree.verify_nodes(nodes_to_delete, to_t, args.workers, rules))
+
         if should_delete:
             print('Deleting, do not interrupt...')
-            Tree.delete_nodes(nodes_to_delete, get_deleting_path(args.directory))
+            with tqdm.tqdm(desc='Deleted', unit=' entries') as bar, stats.phase('delete'):
+                Tree.delete_nodes(nodes_to_delete, get_deleting_path(args.directory), args.workers, bar.update, stats)
+
+    # Report expected deletions for the coming days
+    if args.forecast_days:
+        with stats.phase('forecast'):
+            forecast = tree.forecast(args.days, args.forecast_days)
+        print(f'\nForecast for the next {forecast.horizon} days:')
+        for day, (count, freed) in forecast.day_totals.items():
+            print(f'Day {day}: {count} paths, {size_getter_str(freed)}')
+        for owner_id, totals in sorted(forecast.owner_totals.items(), key=lambda x: -sum(t[1] for t in x[1].values())):
+            print(f'{resolver.get_name(owner_id, str(owner_id))}: ' + ', '.join(f'day {day} {count} paths {size_getter_str(freed)}' for day, (count, freed) in sorted(totals.items())))
+
+    # Report usage per owner, collected while scanning
+    if args.report == 'owners':
+        print(f'\n{"Owner":<16} {"Files":>10} {"Size":>10} {"Unused":>10} {"Tomorrow":>10}')
+        for owner_id, usage in sorted(tree.owner_summary().items(), key=lambda x: -x[1].size):
+            unused = usage.get_unused_size(args.days)
+            tomorrow = usage.get_unused_size(args.days, 1) - unused
+            print(f'{resolver.get_name(owner_id, str(owner_id)):<16} {usage.files:>10} {size_getter_str(usage.size):>10} {size_getter_str(unused):>10} {size_getter_str(tomorrow):>10}')
 
     # Generate future warning emails for each user
     if args.email_domain:
-        # Load user-provided or default email template
-        template_paths = [f'{scan_unused.__path__[0]}/templates']
-        template_name = 'example.html'
-        if args.email_template: 
-            template_paths.append(os.path.dirname(os.path.abspath(os.path.expanduser(args.email_template)))) 
-            template_name = os.path.basename(args.email_template)
-        env = jinja2.Environment(trim_blocks=True, lstrip_blocks=True, loader=jinja2.FileSystemLoader([f'{scan_unused.__path__[0]}/templates'] + ([args.email_template] if args.email_template else [])))
-        template = env.get_template(template_name)
-
         if args.email_days:
-            nodes_to_email = list(tree.iter_nodes_unused(args.days, args.email_days))
+            nodes_to_email = tree.iter_nodes_unused(args.days, args.email_days)
         else:
-            nodes_to_email = list(tree.iter_nodes_unused(args.days, 1))
-        for owner_id, node_group in tqdm.tqdm(itertools.groupby(sorted(nodes_to_email, key=owner_getter), owner_getter), desc='Emails'):
-            owner = pwd.getpwuid(owner_id).pw_name
+            nodes_to_email = tree.iter_nodes_unused(args.days, 1)
+        with stats.phase('query'):
+            nodes_by_owner = group_largest(nodes_to_email, args.email_limit)
+        _send_emails(args, args.directory, nodes_by_owner, resolver, stats)
+
+def _send_emails(args, dir: str, nodes_by_owner: Dict[int, LargestNodes], resolver: OwnerResolver, stats: Stats):
+    '''
+    Email each owner about their largest nodes found in dir, or print the emails with --dryrun.
+    '''
+    template = load_template(args.email_template)
+    def _messages():
+        for owner_id, node_group in tqdm.tqdm(nodes_by_owner.items(), desc='Emails'):
+            owner = resolver.get_name(owner_id)
+            if owner is None:
+                # Once lookups are disabled, the resolver has already said why
+                if resolver.available: logging.warning(f'No user found for uid {owner_id}, not emailing')
+                continue
             if args.email_whitelist and owner not in args.email_whitelist: continue
-            addr, body_chunks = gen_email(template, tree, list(node_group), owner, args)
-            if args.dryrun:
-                print(f'Would have emailed: {addr}\n\t', end='')
-                for chunk in body_chunks:
-                    print(chunk.replace('\n', '\n\t'), end='')
-                print()
-            else:
-                p = subprocess.Popen(['sendmail', '-oi', addr], stdin=subprocess.PIPE)
-                for chunk in body_chunks:
-                    p.stdin.write(chunk.encode())
-                p.stdin.close()
-                p.wait()
-                print(f'Emailed {addr}' if p.returncode == 0 else f'Failed to email {addr}')
+            yield gen_email(template, dir, node_group, owner, args)
+
+    if args.dryrun:
+        for addr, body_chunks in _messages():
+            print(f'Would have emailed: {addr}\n\t', end='')
+            for chunk in body_chunks:
+                print(chunk.replace('\n', '\n\t'), end='')
+            print()
+    else:
+        if args.email_backend == 'smtp':
+            host, _, port = args.smtp_host.partition(':')
+            backend = SmtpBackend(host, int(port or 25), args.email_from, stats=stats)
+        else:
+            backend = SendmailBackend(args.email_workers, stats=stats)
+        with stats.phase('email'):
+            for addr, error in backend.deliver(_messages()):
+                stats.add('emails_sent' if error is None else 'email_errors')
+                print(f'Emailed {addr}' if error is None else f'Failed to email {addr}: {error}')
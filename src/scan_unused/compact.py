@@ -0,0 +1,540 @@
+import os, sys, mmap, struct, time, tempfile, multiprocessing, contextlib
+from array import array
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from scan_unused.core import BaseNode, Forecast, Tree, tally_owners
+from scan_unused.utils import DAY, PathCache
+from scan_unused.stats import Stats
+from scan_unused.rules import PROTECTED, protect
+from scan_unused.walk import Record, walk
+
+'''
+Columnar tree store, roughly 40 bytes per file instead of a Python object each.
+Nodes are kept in pre-order so the subtree of node i is exactly the range [i, end[i]).
+'''
+
+# Bound on the names remembered for interning while building
+_INTERN_LIMIT = 1 << 16
+
+# Below this many nodes the plain loop is quicker than setting up numpy views
+_NUMPY_MIN_NODES = 1 << 12
+
+# Snapshot layout: header, then each array in this order padded to 8 bytes
+_SNAPSHOT_MAGIC = b'SCANUNUS'
+_SNAPSHOT_VERSION = 3
+_SNAPSHOT_FIELDS = (('parent', 'q'), ('end', 'q'), ('size', 'q'), ('last_access', 'd'), ('change_time', 'd'), ('owner', 'I'),
+                    ('is_folder', 'B'), ('name_id', 'I'), ('name_offsets', 'Q'), ('name_data', 'B'))
+# Shard (index, count), count 0 for a full scan, then the length of each field
+_SNAPSHOT_HEADER = struct.Struct(f'=8sIcxxxdII{len(_SNAPSHOT_FIELDS)}Q')
+
+class CompactNode(BaseNode):
+    '''
+    Lightweight view of a single node within a CompactTree.
+    '''
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree: 'CompactTree', index: int):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def name(self) -> str:
+        return self.tree.get_name(self.index)
+
+    @property
+    def size(self) -> int:
+        return self.tree.size[self.index]
+
+    @property
+    def last_access(self) -> float:
+        return self.tree.last_access[self.index]
+
+    @property
+    def owner(self) -> int:
+        return self.tree.owner[self.index]
+
+    @property
+    def is_folder(self) -> bool:
+        return bool(self.tree.is_folder[self.index])
+
+    @property
+    def parent(self) -> Optional['CompactNode']:
+        p = self.tree.parent[self.index]
+        return CompactNode(self.tree, p) if p >= 0 else None
+
+    @property
+    def children(self):
+        if not self.is_folder: return None
+        return [CompactNode(self.tree, i) for i in self.tree.iter_children(self.index)]
+
+    def get_path(self, paths: PathCache=None):
+        return self.tree.get_path(self.index, paths)
+
+    def __eq__(self, other):
+        return isinstance(other, CompactNode) and other.tree is self.tree and other.index == self.index
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+class AccessIndex:
+    '''
+    Nodes bucketed by whole days since last access, relative to a fixed time, and by the
+    same age for their parent. As a parent holds the latest access of its subtree, a node is
+    a top-level result for a cutoff exactly when the cutoff lies between the two, so queries
+    read the matching buckets instead of traversing the tree.
+    '''
+    def __init__(self, tree: 'CompactTree', now: float=None):
+        self.now = now or time.time()
+        self.buckets = {}
+        parent, last_access = tree.parent, tree.last_access
+        for i in range(1, len(parent)):
+            p = parent[i]
+            age = int((self.now - last_access[i]) // DAY)
+            if p:
+                parent_age = int((self.now - last_access[p]) // DAY)
+                # Same day as its parent, so always reported as part of it
+                if parent_age >= age: continue
+            else:
+                parent_age = float('-inf')
+            self.buckets.setdefault(age, {}).setdefault(parent_age, array('q')).append(i)
+
+    def unused(self, days: int) -> List[int]:
+        '''
+        Indices of top-level nodes not accessed in the given number of days, in tree order.
+        '''
+        indices = array('q')
+        for age, by_parent in self.buckets.items():
+            if age >= days:
+                for parent_age, bucket in by_parent.items():
+                    if parent_age < days: indices.extend(bucket)
+        return sorted(indices)
+
+    def expiring(self, days: int, future: int) -> List[int]:
+        '''
+        Indices of top-level nodes that become unused the given number of days ahead, in tree order.
+        '''
+        indices = array('q')
+        if future <= days:
+            for bucket in self.buckets.get(days - future, {}).values():
+                indices.extend(bucket)
+        return sorted(indices)
+
+class CompactTree(Tree):
+    '''
+    Tree held as parallel arrays: parent index, subtree end, size, last_access, ctime,
+    owner, is_folder and an index into an interned name buffer. shard is the (index, count)
+    of the top-level entries held, None when holding all of them.
+    '''
+    def __init__(self):
+        self.parent = array('q')
+        self.end = array('q')
+        self.size = array('q')
+        self.last_access = array('d')
+        self.change_time = array('d')
+        self.owner = array('I')
+        self.is_folder = array('B')
+        self.name_id = array('I')
+        self.name_offsets = array('Q', [0])
+        self.name_data = bytearray()
+        self.scan_time = time.time()
+        self.shard = None
+        self.index = None
+        self.paths = PathCache()
+        self._intern = {}
+        super().__init__(CompactNode(self, 0), {})
+
+    def __len__(self):
+        return len(self.parent)
+
+    def _intern_name(self, name: str) -> int:
+        name_id = self._intern.get(name)
+        if name_id is None:
+            if len(self._intern) >= _INTERN_LIMIT: self._intern.clear()
+            name_id = len(self.name_offsets) - 1
+            self.name_data += os.fsencode(name)
+            self.name_offsets.append(len(self.name_data))
+            self._intern[name] = name_id
+        return name_id
+
+    def _append(self, parent: int, name: str, is_folder: bool, owner: int, size: int, last_access: float, change_time: float) -> int:
+        index = len(self.parent)
+        self.parent.append(parent)
+        self.end.append(index + 1)
+        self.size.append(size)
+        self.last_access.append(last_access)
+        self.change_time.append(change_time)
+        self.owner.append(owner)
+        self.is_folder.append(is_folder)
+        self.name_id.append(self._intern_name(name))
+        return index
+
+    @classmethod
+    def from_dir(cls, dir: str, workers: int=1, shard: Tuple[int, int]=None, stats: 'Stats'=None, rules: 'Rules'=None, backend: str='scandir') -> 'CompactTree':
+        '''
+        Walk dir with the given number of threads, or only a shard (index, count) of its top-level entries.
+        Walk counters and the time spent propagating are added to stats.
+        '''
+        tree = cls.from_records(walk(dir, workers, shard=shard, stats=stats, rules=rules, backend=backend), stats=stats)
+        tree.shard = shard
+        return tree
+
+    @classmethod
+    def from_records(cls, records: Iterable[Record], previous: 'CompactTree'=None, stats: 'Stats'=None) -> 'CompactTree':
+        '''
+        Construct a tree from pre-order walk records, the first being the root folder.
+        With a previous tree, records carry previous indices (see Walker) and only folders
+        whose listing changed, and their ancestors, have sizes/access times recomputed.
+        '''
+        tree = cls()
+        sizes, last_accesses, ends = tree.size, tree.last_access, tree.end
+
+        def _close(index, prev, dirty):
+            ends[index] = len(ends)
+            if previous is None: return
+            if not dirty:
+                sizes[index] = previous.size[prev]
+                last_accesses[index] = previous.last_access[prev]
+            elif ends[index] > index + 1:
+                sizes[index], last_accesses[index] = 0, PROTECTED if last_accesses[index] >= PROTECTED else -1
+                for c in tree.iter_children(index):
+                    sizes[index] += sizes[c]
+                    if last_accesses[c] > last_accesses[index]: last_accesses[index] = last_accesses[c]
+
+        # Folders stay on the stack until their last descendant has been appended
+        stack = []
+        for depth, name, is_folder, owner, size, last_access, change_time, *prev in tally_owners(records, tree.owners, tree.scan_time):
+            while len(stack) > depth:
+                _close(*stack.pop())
+            index = tree._append(stack[-1][0] if stack else -1, name, is_folder, owner, size, last_access, change_time)
+            if is_folder:
+                prev = prev[0] if prev else -1
+                dirty = previous is None or prev < 0 or previous.change_time[prev] != change_time
+                if dirty:
+                    for entry in reversed(stack):
+                        if entry[2]: break
+                        entry[2] = True
+                stack.append([index, prev, dirty])
+        while stack:
+            _close(*stack.pop())
+        tree._intern = {}
+        if previous is None:
+            with stats.phase('propagate') if stats else contextlib.nullcontext():
+                tree.propagate()
+        return tree
+
+    @classmethod
+    def from_tree(cls, other: Tree) -> 'CompactTree':
+        '''
+        Convert a tree of Node objects.
+        '''
+        def _records(node, depth):
+            yield depth, node.name, node.is_folder, node.owner, node.size, node.last_access, 0
+            for c in node.children or []:
+                yield from _records(c, depth + 1)
+        return cls.from_records(_records(other.root, 0))
+
+    @classmethod
+    def merge(cls, trees: List['CompactTree'], name: str=None) -> 'CompactTree':
+        '''
+        Combine trees of the same directory holding disjoint top-level entries, e.g. the shards of one scan.
+        Each tree's nodes are copied as one pre-order range below the shared root, named name if given.
+        Shards must form one complete set, each exactly once.
+        '''
+        first = trees[0]
+        root_name = first.get_name(0)
+        shards = [other.shard for other in trees]
+        if any(shards):
+            count = first.shard[1] if first.shard else 0
+            if not all(shards) or sorted(shards) != [(i, count) for i in range(count)]:
+                found = ', '.join(f'{s[0] + 1}/{s[1]}' if s else 'full scan' for s in shards)
+                raise Exception(f'Cannot merge shards {found}, need each of 1/{count} to {count}/{count} once')
+        names = set()
+        tree = cls()
+        tree.scan_time = min(other.scan_time for other in trees)
+        tree._append(-1, name or root_name, True, first.owner[0], 0, -1, first.change_time[0])
+        for other in trees:
+            if other.get_name(0) != root_name:
+                raise Exception(f'Cannot merge a tree of "{other.get_name(0)}" into one of "{root_name}"')
+            for c in other.iter_children(0):
+                child_name = other.get_name(c)
+                if child_name in names: raise Exception(f'Cannot merge trees both holding "{os.path.join(root_name, child_name)}"')
+                names.add(child_name)
+            base = len(tree) - 1
+            tree.parent.extend(p + base if p else 0 for p in other.parent[1:])
+            tree.end.extend(e + base for e in other.end[1:])
+            for field in ('size', 'last_access', 'change_time', 'owner', 'is_folder'):
+                # Copied as raw bytes, whether held in an array or mapped from a snapshot
+                getattr(tree, field).frombytes(memoryview(getattr(other, field))[1:].tobytes())
+            name_ids = {}
+            for i in range(1, len(other)):
+                name_id = name_ids.get(other.name_id[i])
+                if name_id is None: name_id = name_ids[other.name_id[i]] = tree._intern_name(other.get_name(i))
+                tree.name_id.append(name_id)
+        tree._intern = {}
+
+        # Only the root spans more than one tree
+        tree.end[0] = len(tree)
+        for c in tree.iter_children(0):
+            tree.size[0] += tree.size[c]
+            if tree.last_access[c] > tree.last_access[0]: tree.last_access[0] = tree.last_access[c]
+        tree.owners = None
+        return tree
+
+    @classmethod
+    def from_dir_sharded(cls, dir: str, processes: int, workers: int=1, stats: 'Stats'=None, rules: 'Rules'=None, backend: str='scandir') -> 'CompactTree':
+        '''
+        Scan with one process per shard of the top-level entries, each using the given number of
+        threads, then merge the snapshots they write. Counters of every process are added to stats.
+        '''
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            paths = [os.path.join(snapshot_dir, f'{i}.snap') for i in range(processes)]
+            with multiprocessing.Pool(processes) as pool:
+                counters = pool.starmap(_scan_shard, [(dir, workers, (i, processes), path, stats is not None, rules, backend) for i, path in enumerate(paths)])
+            if stats:
+                for shard_counters in counters:
+                    for name, value in shard_counters.items(): stats.add(name, value)
+            # Snapshots hold the absolute path, but paths are shown as the directory was given
+            return cls.merge([cls.load(path) for path in paths], dir)
+
+    def rescan(self, workers: int=1, stats: 'Stats'=None, rules: 'Rules'=None, backend: str='scandir') -> 'CompactTree':
+        '''
+        Scan the same directory again, only listing directories whose ctime changed.
+        Files in unchanged directories keep their cached size and access time.
+        Folders in unchanged directories are only protected for excluded entries by apply_rules.
+        '''
+        # Rules can protect unchanged folders differently, so their totals are recomputed
+        cached = rules is None and self.last_access[0] < PROTECTED
+        return self.from_records(walk(self.root.name, workers, self, stats=stats, rules=rules, backend=backend), self if cached else None, stats)
+
+    def apply_rules(self, rules: 'Rules'):
+        '''
+        Protect nodes matching rules in a tree whose access times are not protected, e.g. one loaded
+        from a snapshot. Excluded nodes cannot be removed, so are protected too, keeping their folder.
+        '''
+        last_access, end, is_folder = array('d', self.last_access), self.end, self.is_folder
+        absolute = os.path.isabs(self.get_name(0))
+        i, n = 1, len(self)
+        while i < n:
+            path = self.get_path(i)
+            if rules.match(path if absolute else os.path.abspath(path), self.get_name(i), is_folder[i], self.owner[i], self.size[i]):
+                for j in range(i, end[i]): last_access[j] = protect(last_access[j])
+                i = end[i]
+            else:
+                i += 1
+        self.last_access, self.size = last_access, array('q', self.size)
+        self.propagate()
+        self.index = None
+
+    def _get_unprotected_last_access(self) -> array:
+        # Only leaves keep their own access time, so folders are propagated again
+        tree = CompactTree.__new__(CompactTree)
+        tree.parent, tree.end, tree.size = self.parent, self.end, array('q', self.size)
+        tree.last_access = array('d', (t - PROTECTED if t >= PROTECTED else t for t in self.last_access))
+        tree.propagate()
+        return tree.last_access
+
+    def save(self, path: str, protected: bool=False):
+        '''
+        Write a snapshot that can be reloaded with load, replacing path atomically.
+        Access times are saved unprotected, so rules are applied again after loading unless
+        protected is given, for snapshots only ever loaded with the same rules. The root is saved
+        as an absolute path.
+        '''
+        names = [name for name, _ in _SNAPSHOT_FIELDS]
+        fields = [getattr(self, name) for name in names]
+        if not protected and self.last_access[0] >= PROTECTED:
+            fields[names.index('last_access')] = self._get_unprotected_last_access()
+        root = self.get_name(0)
+        if not os.path.isabs(root):
+            # Later runs check the directory they were given against it, wherever they run from
+            name_id, name_offsets = array('I', self.name_id), array('Q', self.name_offsets)
+            name_data = bytearray(self.name_data) + os.fsencode(os.path.abspath(root))
+            name_id[0] = len(name_offsets) - 1
+            name_offsets.append(len(name_data))
+            fields[names.index('name_id')], fields[names.index('name_offsets')], fields[names.index('name_data')] = name_id, name_offsets, name_data
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, sys.byteorder[0].encode(), self.scan_time, *(self.shard or (0, 0)), *map(len, fields)))
+            for field in fields:
+                data = memoryview(field).cast('B')
+                f.write(data)
+                f.write(b'\0' * (-len(data) % 8))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'CompactTree':
+        '''
+        Memory-map a snapshot written by save. Nothing is deserialised, arrays are read in place.
+        '''
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, byteorder, scan_time, shard_index, shard_count, *counts = _SNAPSHOT_HEADER.unpack_from(buffer)
+        if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION or byteorder != sys.byteorder[0].encode():
+            raise Exception(f'Unsupported snapshot {path}')
+
+        tree = cls.__new__(cls)
+        offset = _SNAPSHOT_HEADER.size
+        view = memoryview(buffer)
+        for (name, typecode), count in zip(_SNAPSHOT_FIELDS, counts):
+            length = count * array(typecode).itemsize
+            setattr(tree, name, view[offset:offset + length].cast(typecode))
+            offset += length + (-length % 8)
+        tree.scan_time = scan_time
+        tree.shard = (shard_index, shard_count) if shard_count else None
+        tree.index = None
+        tree.paths = PathCache()
+        tree._intern = {}
+        tree._buffer = buffer
+        Tree.__init__(tree, CompactNode(tree, 0))
+        return tree
+
+    def propagate(self):
+        '''
+        Set non-empty folders to the total size and latest access of their contents.
+        Folders protected by the walk (see Walker) stay protected.
+        Runs as bulk reductions when numpy is installed.
+        '''
+        if numpy is not None and len(self) >= _NUMPY_MIN_NODES: return self._propagate_numpy()
+        size, last_access, parent, end = self.size, self.last_access, self.parent, self.end
+        for i in range(len(end)):
+            if end[i] > i + 1:
+                size[i] = 0
+                last_access[i] = PROTECTED if last_access[i] >= PROTECTED else -1
+
+        # Children always come after their parent, so a reverse pass sees them first
+        for i in range(len(end) - 1, 0, -1):
+            p = parent[i]
+            size[p] += size[i]
+            if last_access[i] > last_access[p]: last_access[p] = last_access[i]
+
+    def _propagate_numpy(self):
+        # Views share memory with the arrays, or with the snapshot for loaded trees, so updates are made in place
+        parent, end, size, last_access = (numpy.frombuffer(a, memoryview(a).format) for a in (self.parent, self.end, self.size, self.last_access))
+        inner = end > numpy.arange(1, len(end) + 1)
+        size[inner] = 0
+        last_access[inner] = numpy.where(last_access[inner] >= PROTECTED, PROTECTED, -1)
+
+        # Stepping to the next node in pre-order goes one level down, then up one for every subtree ending there
+        n = len(end)
+        depth = numpy.arange(n) - numpy.cumsum(numpy.bincount(end, minlength=n + 1)[:n])
+
+        # Fold each level into the one above, deepest first. Within a level nodes stay in tree
+        # order, so siblings are contiguous and each parent is one segment of a reduceat
+        order = numpy.argsort(depth, kind='stable')
+        starts = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(depth))))
+        for level in range(len(starts) - 2, 0, -1):
+            nodes = order[starts[level]:starts[level + 1]]
+            parents = parent[nodes]
+            segments = numpy.flatnonzero(numpy.concatenate(([True], parents[1:] != parents[:-1])))
+            targets = parents[segments]
+            size[targets] += numpy.add.reduceat(size[nodes], segments)
+            last_access[targets] = numpy.maximum(last_access[targets], numpy.maximum.reduceat(last_access[nodes], segments))
+
+    def build_index(self, now: float=None):
+        '''
+        Index access times so iter_nodes_unused is answered relative to now without traversing the tree.
+        Must be rebuilt if sizes or access times change.
+        '''
+        self.index = AccessIndex(self, now)
+
+    def forecast(self, days: int, horizon: int=None, now: float=None) -> Forecast:
+        '''
+        Label every top-level node expiring in the next horizon days (at most days) with the day it
+        will be deleted, assuming it is run every day, in a single reverse pass over the arrays.
+        '''
+        forecast = Forecast(days, horizon, now)
+        parent, size, last_access, is_folder = self.parent, self.size, self.last_access, self.is_folder
+        freed = array('q', (0 if f else s for s, f in zip(size, is_folder)))
+        labelled = []
+        for i in range(len(parent) - 1, 0, -1):
+            p = parent[i]
+            day = forecast.get_day(last_access[i])
+            if p and day == forecast.get_day(last_access[p]):
+                freed[p] += freed[i]
+            elif 1 <= day <= forecast.horizon:
+                labelled.append((i, day))
+
+        # Children always come after their parent, so reversing restores tree order
+        for i, day in reversed(labelled):
+            forecast.add(CompactNode(self, i), day, freed[i])
+        return forecast
+
+    def get_name(self, index: int) -> str:
+        name_id = self.name_id[index]
+        return os.fsdecode(bytes(self.name_data[self.name_offsets[name_id]:self.name_offsets[name_id + 1]]))
+
+    def get_path(self, index: int, paths: PathCache=None) -> str:
+        '''
+        Full path of index, reusing folder paths from the given cache or else the tree's own.
+        '''
+        p = self.parent[index]
+        if p < 0: return self.get_name(index)
+        return os.path.join((paths if paths is not None else self.paths).get_path(p, self._get_parent, self.get_name), self.get_name(index))
+
+    def _get_parent(self, index: int) -> Optional[int]:
+        p = self.parent[index]
+        return p if p >= 0 else None
+
+    def iter_children(self, index: int) -> Iterable[int]:
+        i, end = index + 1, self.end[index]
+        while i < end:
+            yield i
+            i = self.end[i]
+
+    def count_nodes(self):
+        '''
+        Count nodes below the root.
+        '''
+        return len(self) - 1
+
+    def iter_nodes(self, satifies: Callable[[CompactNode], bool]):
+        '''
+        Iterate nodes when satisfies is true, skips sub-nodes.
+        '''
+        i, n, end = 1, len(self), self.end
+        while i < n:
+            node = CompactNode(self, i)
+            if satifies(node):
+                yield node
+                i = end[i]
+            else:
+                i += 1
+
+    def iter_nodes_range(self, range: Tuple[Optional[float], Optional[float]], inverse: bool=False):
+        '''
+        Iterate nodes in a given (inclusive) timestamp range.
+        '''
+        i, n, end, last_access = 1, len(self), self.end, self.last_access
+        low, high = range
+        while i < n:
+            t = last_access[i]
+            if inverse ^ ((not low or t >= low) and (not high or t <= high)):
+                yield CompactNode(self, i)
+                i = end[i]
+            elif not inverse and low and t < low:
+                # Nothing below was accessed later than this node
+                i = end[i]
+            else:
+                i += 1
+
+    def iter_nodes_unused(self, days: int, future: int=None):
+        '''
+        Iterate nodes that have not been accessed in the given number of days, using the index if built.
+        Use future to see what files will be deleted on a given day ahead, assuming it is run every day.
+        '''
+        if self.index is None:
+            yield from super().iter_nodes_unused(days, future)
+            return
+        for i in (self.index.expiring(days, future) if future else self.index.unused(days)):
+            yield CompactNode(self, i)
+
+def _scan_shard(dir: str, workers: int, shard: Tuple[int, int], path: str, with_stats: bool, rules: 'Rules', backend: str) -> Dict[str, int]:
+    stats = Stats() if with_stats else None
+    # Merged straight back with the same rules
+    CompactTree.from_dir(dir, workers, shard, stats, rules, backend).save(path, protected=True)
+    return stats.counters if stats else {}
@@ -1,17 +1,39 @@
-import os, datetime, shutil, stat, logging, tempfile
-from typing import Callable, Optional, Iterable, List, Tuple
+import os, datetime, shutil, stat, logging, tempfile, time, operator
+from typing import Callable, Dict, Optional, Iterable, Iterator, List, Tuple
 
-from scan_unused.utils import get_days_ago_str, size_getter_str
+from scan_unused.utils import DAY, PathCache, get_days_ago_str, size_getter_str
+from scan_unused.walk import Record, walk
+from scan_unused.rules import PROTECTED
+from scan_unused.delete import remove_tree
 
 '''
 Query the in-memory file structure multiple times to forcast what will get deleted / 
 what is preventing something from getting deleted.
 '''
 
-class Node:
+class BaseNode:
+    '''
+    Formatting shared by every node representation.
+    '''
+    __slots__ = ()
+
+    def get_size_str(self):
+        return size_getter_str(self.size)
+    
+    def get_last_access_str(self):
+        if self.last_access >= PROTECTED: return 'protected'
+        return f'{get_days_ago_str(self.last_access)} days ago'
+    
+    def __repr__(self):
+        if self.last_access >= PROTECTED: return f'{self.get_path()} (protected, {size_getter_str(self.size)})'
+        return f'{self.get_path()} ({get_days_ago_str(self.last_access)} days since access, {size_getter_str(self.size)})'
+
+class Node(BaseNode):
     '''
     Used to store file/folder metadata as tree structure.
     '''
+    __slots__ = ('name', 'size', 'last_access', 'is_folder', 'children', 'owner', 'parent')
+
     def __init__(self, name: str, is_folder: bool, owner: int, parent: 'Node'=None):
         self.name = name
         self.size = 0
@@ -21,91 +43,188 @@ class Node:
         self.owner = owner
         self.parent = parent
 
-    def get_path(self):
+    def get_path(self, paths: PathCache=None):
+        '''
+        Full path, reusing folder paths from the given cache when building many.
+        '''
+        if paths is not None and self.parent is not None:
+            return os.path.join(paths.get_path(self.parent, _get_parent, _get_name), self.name)
         full_list = []
         curr = self
         while curr is not None:
             full_list.append(curr.name)
             curr = curr.parent
-
         return os.path.join(*reversed(full_list))
-    
-    def get_size_str(self):
-        return size_getter_str(self.size)
-    
-    def get_last_access_str(self):
-        return f'{get_days_ago_str(self.last_access)} days ago'
-    
-    def __repr__(self):
-        return f'{self.get_path()} ({get_days_ago_str(self.last_access)} days since access, {size_getter_str(self.size)})'
+
+_get_parent = operator.attrgetter('parent')
+_get_name = operator.attrgetter('name')
+
+class Forecast:
+    '''
+    Top-level nodes by the day ahead they will be deleted, with per-day and per-owner totals.
+    Bytes only count what is freed that day, excluding contents expiring earlier.
+    '''
+    def __init__(self, days: int, horizon: int=None, now: float=None):
+        self.days = days
+        self.horizon = min(horizon or days, days)
+        self.now = now or datetime.datetime.now().timestamp()
+        self.nodes = {day: [] for day in range(1, self.horizon + 1)}
+        self.day_totals = {day: [0, 0] for day in range(1, self.horizon + 1)}
+        self.owner_totals = {}
+
+    def get_day(self, last_access: float) -> int:
+        '''
+        Days ahead a node with this access time is deleted, zero or less if already unused.
+        '''
+        return self.days - int((self.now - last_access) // DAY)
+
+    def add(self, node, day: int, freed: int):
+        if day in self.nodes:
+            self.nodes[day].append(node)
+            self.day_totals[day][0] += 1
+            self.day_totals[day][1] += freed
+            totals = self.owner_totals.setdefault(node.owner, {}).setdefault(day, [0, 0])
+            totals[0] += 1
+            totals[1] += freed
+
+class OwnerUsage:
+    '''
+    Totals for the files of a single owner, with bytes by whole days since last access.
+    '''
+    __slots__ = ('size', 'files', 'age_sizes')
+
+    def __init__(self):
+        self.size = 0
+        self.files = 0
+        self.age_sizes = {}
+
+    def add(self, size: int, age: int):
+        self.size += size
+        self.files += 1
+        self.age_sizes[age] = self.age_sizes.get(age, 0) + size
+
+    def get_unused_size(self, days: int, future: int=0) -> int:
+        '''
+        Bytes not accessed in the given number of days, or that will not have been within future days.
+        '''
+        return sum(size for age, size in self.age_sizes.items() if age >= days - future)
+
+def tally_owners(records: Iterable[Record], owners: Dict[int, OwnerUsage], now: float) -> Iterator[Record]:
+    '''
+    Pass records through, adding every file to its owner's usage.
+    '''
+    for record in records:
+        if not record[2]:
+            usage = owners.get(record[3])
+            if usage is None: usage = owners[record[3]] = OwnerUsage()
+            usage.add(record[4], int((now - record[5]) // DAY))
+        yield record
+
+def get_latest_access(path: str, workers: int=1, rules: 'Rules'=None) -> float:
+    '''
+    Access time from_dir would give the folder at path, folded from the walk without holding its tree.
+    '''
+    latest, folder = -1, None
+    for depth, _, is_folder, _, _, last_access, *_ in walk(path, workers, rules=rules):
+        if folder is not None:
+            # A folder only counts with its own time when empty, otherwise only if protected by the walk
+            folder_depth, folder_access = folder
+            if depth <= folder_depth: latest = max(latest, folder_access)
+            elif folder_access >= PROTECTED: latest = max(latest, PROTECTED)
+        if is_folder:
+            folder = depth, last_access
+        else:
+            folder = None
+            latest = max(latest, last_access)
+    if folder is not None: latest = max(latest, folder[1])
+    return latest
 
 class Tree:
-    def __init__(self, root: Node):
+    def __init__(self, root: Node, owners: Dict[int, OwnerUsage]=None):
         self.root = root
+        self.owners = owners
 
-    def from_dir(dir: str) -> 'Tree':
+    @classmethod
+    def from_dir(cls, dir: str, workers: int=1, shard: Tuple[int, int]=None, stats: 'Stats'=None, rules: 'Rules'=None, backend: str='scandir') -> 'Tree':
         '''
-        Construct a tree given any directory.
+        Construct a tree given any directory, scanning with the given number of threads.
+        With a shard (index, count), only that share of the top-level entries is included.
+        With rules, excluded entries are skipped and protected ones never become unused.
+        The backend lists directories, see walk.get_scan_dir.
         '''
-        stats = os.stat(dir)
-        if not stat.S_ISDIR(stats.st_mode):
-            raise Exception('Must provide valid directory')
-        root = Node(dir, True, stats.st_uid)
+        return cls.from_records(walk(dir, workers, shard=shard, stats=stats, rules=rules, backend=backend))
 
-        # Unwrapped recursion for large FS
-        stack = [root]
-        while len(stack):
-            parent = stack.pop()
-            full = parent.get_path()
-            try:
-                for entry in os.scandir(full):
-                    stats = entry.stat(follow_symlinks=False)
-                    curr = Node(entry.name, entry.is_dir() and not entry.is_symlink(), stats.st_uid, parent)
-                    if curr.is_folder: 
-                        # Folders use mtime (but non-empty will get overwritten in recurse)
-                        curr.last_access = stats.st_mtime 
-                        stack.append(curr)
-                    else:
-                        # Files use atime
-                        curr.last_access = stats.st_atime if not entry.is_symlink() else stats.st_mtime
-                        curr.size = stats.st_size
-                    parent.children.append(curr)
-            except OSError:
-                continue
+    @classmethod
+    def from_records(cls, records: Iterable[Record]) -> 'Tree':
+        '''
+        Construct a tree from pre-order walk records, the first being the root folder.
+        '''
+        # Records arrive in pre-order, so the stack only holds the current path
+        stack = []
+        owners = {}
 
-        # Still need to recurse for sizes/access propagation
-        def _recurse(node):
+        def _close(node):
+            # Every child has been closed already, so sizes/access propagate without recursing
             if node.children:
-                node.last_access = -1
                 node.size = 0
+                # Folders protected by the walk (see Walker) stay protected
+                node.last_access = PROTECTED if node.last_access >= PROTECTED else -1
                 for c in node.children:
-                    if c.children: _recurse(c)
                     node.size += c.size
-                    node.last_access = max(node.last_access, c.last_access)
-        _recurse(root)
-        return Tree(root)
+                    if c.last_access > node.last_access: node.last_access = c.last_access
+
+        for depth, name, is_folder, owner, size, last_access, _ in tally_owners(records, owners, time.time()):
+            while len(stack) > depth: _close(stack.pop())
+            curr = Node(name, is_folder, owner, stack[-1] if stack else None)
+            curr.size = size
+            curr.last_access = last_access
+            if stack: stack[-1].children.append(curr)
+            if is_folder: stack.append(curr)
+        root = stack[0]
+        while stack: _close(stack.pop())
+        return cls(root, owners)
     
+    def owner_summary(self) -> Dict[int, OwnerUsage]:
+        '''
+        Usage of every owner, as collected while building the tree or counted once otherwise.
+        '''
+        if self.owners is None:
+            now = time.time()
+            self.owners = {}
+            for node in self.iter_nodes(lambda n: not n.is_folder):
+                usage = self.owners.get(node.owner)
+                if usage is None: usage = self.owners[node.owner] = OwnerUsage()
+                usage.add(node.size, int((now - node.last_access) // DAY))
+        return self.owners
+
     def count_nodes(self):
         '''
         Count unwrapped tree nodes.
         '''
-        def _recurse(node):
-            count = 0
-            for c in node.children:
-                count += 1
-                if c.is_folder: count += _recurse(c)
-            return count
-        return _recurse(self.root)
+        count = 0
+        stack = [self.root.children]
+        while stack:
+            children = stack.pop()
+            count += len(children)
+            for c in children:
+                if c.children: stack.append(c.children)
+        return count
 
     def iter_nodes(self, satifies: Callable[[Node], bool]):
         '''
         Iterate unwrapped tree nodes when satisfies is true, skips sub-nodes.
         '''
-        def _recurse(node):
-            for c in node.children:
-                if satifies(c): yield c
-                elif c.is_folder: yield from _recurse(c)
-        yield from _recurse(self.root)
+        # One iterator per open folder, so each node is yielded directly rather than through every level
+        stack = [iter(self.root.children)]
+        while stack:
+            for c in stack[-1]:
+                if satifies(c):
+                    yield c
+                elif c.is_folder:
+                    stack.append(iter(c.children))
+                    break
+            else:
+                stack.pop()
 
     def iter_nodes_range(self, range: Tuple[Optional[float], Optional[float]], inverse: bool=False):
         '''
@@ -119,27 +238,135 @@ class Tree:
         Use future to see what files will be deleted on a given day ahead, assuming it is run every day.
         '''
         if future:
-            # e.g. (3 days, 1 day in future) ->  in range [-3, -2]
-            if future < days:
-                from_t = (datetime.datetime.now() - datetime.timedelta(days=future+days-1))
-                to_t = (datetime.datetime.now() - datetime.timedelta(days=future-1+days-1))
+            # e.g. (3 days, 1 day in future) ->  in range [-3, -2], (3 days, 2 days in future) -> in range [-2, -1]
+            if future <= days:
+                from_t = (datetime.datetime.now() - datetime.timedelta(days=days-future+1))
+                to_t = (datetime.datetime.now() - datetime.timedelta(days=days-future))
                 yield from self.iter_nodes_range((from_t.timestamp(), to_t.timestamp()))
         else:
             # e.g. (3 days) -> in range [-infinity, -3]
             to_t = (datetime.datetime.now() - datetime.timedelta(days=days))
             yield from self.iter_nodes_range((None, to_t.timestamp()))
 
+    def forecast(self, days: int, horizon: int=None, now: float=None) -> 'Forecast':
+        '''
+        Label every top-level node expiring in the next horizon days (at most days) with the day it
+        will be deleted, assuming it is run every day, in a single post-order pass.
+        '''
+        forecast = Forecast(days, horizon, now)
+        freed = {}
+        stack = [(self.root, iter(self.root.children))]
+        while stack:
+            node, children = stack[-1]
+            c = next(children, None)
+            if c is not None:
+                if c.is_folder: stack.append((c, iter(c.children)))
+                else: freed[c] = c.size
+                continue
+            stack.pop()
+
+            # Children expiring on another day were deleted earlier, so only count the rest
+            day = forecast.get_day(node.last_access)
+            total = 0
+            for c in node.children:
+                c_freed = freed.pop(c)
+                c_day = forecast.get_day(c.last_access)
+                if c_day == day and stack: total += c_freed
+                else: forecast.add(c, c_day, c_freed)
+            freed[node] = total
+        return forecast
+
+    @staticmethod
+    def stream_unused(dir: str, days: int, workers: int=1, skip: str=None, stats: 'Stats'=None, rules: 'Rules'=None, backend: str='scandir') -> Iterator[Node]:
+        '''
+        Iterate nodes not accessed in the given number of days while walking dir, without keeping the tree.
+        A folder's nodes are freed once it has been walked, so memory is bounded by depth x fan-out plus
+        whatever the caller holds on to. Yielded nodes keep their parents but not their children.
+        '''
+        before = (datetime.datetime.now() - datetime.timedelta(days=days)).timestamp()
+
+        # Open folders as [node, old children waiting on it, known to be recent, has children]
+        stack = []
+
+        def _report(node):
+            # Fold a finished node into its parent, the folder on top of the stack
+            entry = stack[-1]
+            parent = entry[0]
+            if not entry[3]:
+                parent.size, parent.last_access, entry[3] = 0, PROTECTED if parent.last_access >= PROTECTED else -1, True
+            parent.size += node.size
+            parent.last_access = max(parent.last_access, node.last_access)
+            if node.last_access > before:
+                # Every ancestor is now recent, so anything waiting on them can go
+                for ancestor in reversed(stack):
+                    if ancestor[2]: break
+                    ancestor[2] = True
+                    yield from ancestor[1]
+                    ancestor[1] = []
+            elif entry[2]:
+                yield node
+            else:
+                entry[1].append(node)
+
+        skip_depth = None
+        for depth, name, is_folder, owner, size, last_access, _ in walk(dir, workers, stats=stats, rules=rules, backend=backend):
+            if skip_depth is not None:
+                if depth > skip_depth: continue
+                skip_depth = None
+            if depth == 1 and name == skip:
+                skip_depth = depth
+                continue
+
+            while len(stack) > depth:
+                node = stack.pop()[0]
+                yield from _report(node)
+            curr = Node(name, is_folder, owner, stack[-1][0] if stack else None)
+            curr.size = size
+            curr.last_access = last_access
+            if is_folder:
+                # Root is never deleted, so everything directly below it is reported as soon as it is old
+                stack.append([curr, [], not stack or last_access >= PROTECTED, False])
+            else:
+                yield from _report(curr)
+        while len(stack) > 1:
+            node = stack.pop()[0]
+            yield from _report(node)
+
+    @staticmethod
+    def verify_nodes(nodes: Iterable[Node], before: float, workers: int=1, rules: 'Rules'=None):
+        '''
+        Rescan nodes whose cached access times may be stale, only keeping those still last accessed before the given time.
+        With rules, nodes now protected or holding excluded entries are dropped too.
+        '''
+        paths = PathCache()
+        for node in nodes:
+            full = node.get_path(paths)
+            try:
+                if node.is_folder:
+                    if rules and rules.match(os.path.abspath(full), node.name, True, node.owner, 0): continue
+                    last_access = get_latest_access(full, workers, rules)
+                    # Empty, so as old as its last change
+                    if last_access < 0: last_access = os.stat(full).st_mtime
+                else:
+                    stats = os.stat(full, follow_symlinks=False)
+                    if rules and rules.match(os.path.abspath(full), node.name, False, stats.st_uid, stats.st_size): continue
+                    last_access = stats.st_mtime if stat.S_ISLNK(stats.st_mode) else stats.st_atime
+            except OSError:
+                continue
+            if last_access <= before: yield node
+
     @staticmethod
-    def delete_nodes(nodes: Iterable[Node], move_path: str):
+    def delete_nodes(nodes: Iterable[Node], move_path: str, workers: int=1, progress: Callable[[int], None]=None, stats: 'Stats'=None) -> int:
         '''
         Delete list of nodes quickly. Assumes nodes are in traversed order.
+        Nodes are first moved aside as they are iterated, then removed concurrently, returning the number of their entries removed.
         '''
         try:
-            nodes = list(nodes)
             parent = None
             parent_tmp_path = None
+            paths = PathCache()
             for node in nodes:
-                full = node.get_path()
+                full = node.get_path(paths)
                 if parent != node.parent:
                     try:
                         # Create tempfile temporary with same permissions
@@ -151,12 +378,18 @@ class Tree:
                         raise e
                 try:
                     shutil.move(full, parent_tmp_path,)
+                    if stats: stats.add('deleted_bytes', node.size)
                 except OSError as e:
                     logging.exception(f'Failed to move {full}')
+                    if stats: stats.add('delete_errors')
             try:
-                shutil.rmtree(move_path)
+                # Neither move_path nor the temporary folders in it were asked to be deleted
+                removed = remove_tree(move_path, workers, progress, counted_depth=2)
             except OSError as e:
                 logging.exception(f'Failed to delete {move_path}')
+                removed = 0
+            if stats: stats.add('deleted_entries', removed)
+            return removed
         except (BaseException) as e:
             logging.exception(f'Interrupted during deletion')
             raise e
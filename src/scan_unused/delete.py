@@ -0,0 +1,136 @@
+import os, threading, logging
+from typing import Callable, Optional
+
+'''
+Concurrent removal of a directory tree. Directories are listed and their files unlinked
+relative to open directory descriptors, and each directory is removed as soon as the last
+of its subdirectories is gone.
+'''
+
+_DIR_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) | getattr(os, 'O_NOFOLLOW', 0)
+
+class _Dir:
+    '''
+    Directory being emptied, kept open until its pending subdirectories reach zero.
+    '''
+    __slots__ = ('parent', 'name', 'depth', 'fd', 'pending')
+
+    def __init__(self, parent: Optional['_Dir'], name: str):
+        self.parent = parent
+        self.name = name
+        self.depth = parent.depth + 1 if parent else 0
+        self.fd = None
+        self.pending = 1
+
+class Remover:
+    '''
+    Pool of threads emptying directories depth-first from a shared stack. With a single
+    worker everything runs on the calling thread. An unexpected error in any thread, e.g.
+    from progress, stops them all and is raised by remove_tree.
+    Entries less deep than counted_depth, e.g. folders only holding what is being deleted,
+    are removed without being counted or reported to progress.
+    '''
+    def __init__(self, workers: int=1, progress: Callable[[int], None]=None, counted_depth: int=0):
+        self.workers = max(1, workers)
+        self.progress = progress
+        self.counted_depth = counted_depth
+        self.cond = threading.Condition()
+        self.stack = []
+        self.finished = False
+        self.removed = 0
+        self.errors = 0
+        self.error = None
+        self.top_fd = None
+
+    def _parent_fd(self, d: _Dir) -> int:
+        return d.parent.fd if d.parent else self.top_fd
+
+    def _empty(self, d: _Dir):
+        removed, errors, subdirs = 0, 0, []
+        try:
+            d.fd = os.open(d.name, _DIR_FLAGS, dir_fd=self._parent_fd(d))
+            with os.scandir(d.fd) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(_Dir(d, entry.name))
+                        continue
+                    try:
+                        os.unlink(entry.name, dir_fd=d.fd)
+                        removed += 1
+                    except OSError:
+                        errors += 1
+        except OSError:
+            errors += 1
+        if d.depth + 1 < self.counted_depth: removed = 0
+        with self.cond:
+            self.removed += removed
+            self.errors += errors
+            d.pending += len(subdirs)
+            self.stack.extend(subdirs)
+            self.cond.notify_all()
+        if self.progress and removed: self.progress(removed)
+        self._release(d)
+
+    def _release(self, d: _Dir):
+        # Walk upwards removing every directory whose last pending child just finished
+        while d is not None:
+            with self.cond:
+                d.pending -= 1
+                if d.pending: return
+            removed = 0
+            try:
+                if d.fd is not None: os.close(d.fd)
+                os.rmdir(d.name, dir_fd=self._parent_fd(d))
+                removed = 1
+            except OSError:
+                pass
+            with self.cond:
+                self.errors += 1 - removed
+                if d.depth < self.counted_depth: removed = 0
+                self.removed += removed
+                if d.parent is None:
+                    self.finished = True
+                    self.cond.notify_all()
+            if self.progress and removed: self.progress(removed)
+            d = d.parent
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.stack and not self.finished:
+                    self.cond.wait()
+                if self.finished: return
+                d = self.stack.pop()
+            try:
+                self._empty(d)
+            except BaseException as e:
+                with self.cond:
+                    if self.error is None: self.error = e
+                    self.finished = True
+                    self.cond.notify_all()
+                return
+
+    def remove_tree(self, path: str) -> int:
+        '''
+        Remove path and everything below it, returning the number of entries removed.
+        '''
+        path = os.path.abspath(path)
+        self.top_fd = os.open(os.path.dirname(path), _DIR_FLAGS)
+        try:
+            self.stack = [_Dir(None, os.path.basename(path))]
+            threads = [threading.Thread(target=self._run, daemon=True) for _ in range(self.workers - 1)]
+            for t in threads: t.start()
+            self._run()
+            for t in threads: t.join()
+        finally:
+            os.close(self.top_fd)
+        if self.error is not None: raise self.error
+        if self.errors:
+            logging.error(f'Failed to delete {self.errors} entries in {path}')
+        return self.removed
+
+def remove_tree(path: str, workers: int=1, progress: Callable[[int], None]=None, counted_depth: int=0) -> int:
+    '''
+    Remove path with the given number of threads, see Remover.remove_tree.
+    '''
+    return Remover(workers, progress, counted_depth).remove_tree(path)
@@ -0,0 +1,122 @@
+import os, sys, stat, struct, ctypes, threading
+from typing import Callable, List, Optional, Tuple
+
+'''
+Linux directory listing through raw getdents64 and statx calls. Each directory is read in
+large batches through one descriptor, and each entry is stat'd relative to it asking only
+for the fields the tree needs.
+'''
+
+_STATX_TYPE, _STATX_MODE, _STATX_UID, _STATX_ATIME, _STATX_MTIME, _STATX_CTIME, _STATX_SIZE = 0x1, 0x2, 0x8, 0x20, 0x40, 0x80, 0x200
+_STATX_MASK = _STATX_TYPE | _STATX_MODE | _STATX_UID | _STATX_ATIME | _STATX_MTIME | _STATX_CTIME | _STATX_SIZE
+# AT_SYMLINK_NOFOLLOW | AT_STATX_SYNC_AS_STAT, as entries are deleted based on atimes that must
+# not come from a stale attribute cache, e.g. of NFS or Lustre
+_STATX_FLAGS = 0x100
+
+_RECLEN, _RECLEN_OFFSET, _NAME = struct.Struct('=H'), 16, 19
+# mask, uid, mode, size, then atime, ctime and mtime as (seconds, nanoseconds)
+_STATX = struct.Struct('=I12x4xI4xH10xQ16xqI4x16xqI4xqI4x')
+_STATX_BYTES = 256
+_GETDENTS_BYTES = 1 << 18
+
+def _load():
+    # getdents64 and statx wrappers need glibc 2.30 and 2.28
+    if not sys.platform.startswith('linux'): return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        getdents, statx = libc.getdents64, libc.statx
+    except (OSError, AttributeError):
+        return None
+    getdents.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t)
+    getdents.restype = ctypes.c_ssize_t
+    statx.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.c_void_p)
+    statx.restype = ctypes.c_int
+    return getdents, statx
+
+_loaded = _load()
+_buffers = threading.local()
+
+def available() -> bool:
+    '''
+    Whether this platform supports scan_dir, checked by stat'ing the current directory.
+    '''
+    if _loaded is None: return False
+    try:
+        return _statx(os.open('.', os.O_RDONLY | os.O_DIRECTORY), b'.', close=True) is not None
+    except OSError:
+        return False
+
+def _get_buffers() -> Tuple[ctypes.Array, ctypes.Array]:
+    buffers = getattr(_buffers, 'value', None)
+    if buffers is None:
+        buffers = _buffers.value = (ctypes.create_string_buffer(_GETDENTS_BYTES), ctypes.create_string_buffer(_STATX_BYTES))
+    return buffers
+
+def _check(result: int):
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+def _statx(fd: int, name: bytes, close: bool=False) -> Optional[tuple]:
+    '''
+    (uid, mode, size, atime, mtime, ctime) of name relative to fd, None if the filesystem
+    could not provide every field.
+    '''
+    buffer = _get_buffers()[1]
+    try:
+        _check(_loaded[1](fd, name, _STATX_FLAGS, _STATX_MASK, buffer))
+    finally:
+        if close: os.close(fd)
+    mask, uid, mode, size, a, a_ns, c, c_ns, m, m_ns = _STATX.unpack_from(buffer)
+    if mask & _STATX_MASK != _STATX_MASK: return None
+    # Same rounding as os.stat
+    return uid, mode, size, a + a_ns * 1e-9, m + m_ns * 1e-9, c + c_ns * 1e-9
+
+def _read_names(fd: int, counts: List[int]) -> List[bytes]:
+    getdents, buffer = _loaded[0], _get_buffers()[0]
+    names = []
+    while True:
+        read = _check(getdents(fd, buffer, _GETDENTS_BYTES))
+        counts[1] += 1
+        if not read: return names
+        data = ctypes.string_at(buffer, read)
+        find, offset = data.find, 0
+        while offset < read:
+            # linux_dirent64 is (u64 ino, s64 off, u16 reclen, u8 type, name)
+            name = data[offset + _NAME:find(b'\0', offset + _NAME)]
+            offset += _RECLEN.unpack_from(data, offset + _RECLEN_OFFSET)[0]
+            if name != b'.' and name != b'..': names.append(name)
+
+def scan_dir(path: str, on_error: Callable[[OSError], None]=None, skip: Callable[[str, str], bool]=None, counts: List[int]=None) -> List[tuple]:
+    '''
+    Same as walk.scan_dir. counts, if given, is a [stat calls, getdents calls] list added to.
+    '''
+    counts = counts if counts is not None else [0, 0]
+    entries = []
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+    except OSError as e:
+        if on_error: on_error(e)
+        return entries
+    try:
+        for raw in _read_names(fd, counts):
+            name = os.fsdecode(raw)
+            if skip and skip(os.path.join(path, name), name): continue
+            counts[0] += 1
+            fields = _statx(fd, raw)
+            if fields is None:
+                # Filesystem without statx support for some field
+                counts[0] += 1
+                s = os.stat(raw, dir_fd=fd, follow_symlinks=False)
+                fields = (s.st_uid, s.st_mode, s.st_size, s.st_atime, s.st_mtime, s.st_ctime)
+            uid, mode, size, atime, mtime, ctime = fields
+            if stat.S_ISDIR(mode):
+                entries.append((name, True, uid, 0, mtime, ctime))
+            else:
+                entries.append((name, False, uid, size, atime if not stat.S_ISLNK(mode) else mtime, ctime))
+    except OSError as e:
+        if on_error: on_error(e)
+    finally:
+        os.close(fd)
+    return entries
@@ -0,0 +1,113 @@
+import subprocess, smtplib, socket, getpass, collections, time, concurrent.futures
+from typing import Iterable, Iterator, Optional, Sequence, Tuple
+
+'''
+Email delivery backends. Each takes (address, message chunks) pairs, rendering them lazily
+on the calling thread, and yields (address, error) as they complete, error being None on success.
+'''
+
+Message = Tuple[str, Iterable[str]]
+
+class SendmailBackend:
+    '''
+    Pipe each message into its own sendmail process, running up to workers at once.
+    Messages are rendered before being handed to a worker, so templates and nodes are only
+    ever read from the calling thread.
+    '''
+    def __init__(self, workers: int=4, command: Sequence[str]=('sendmail', '-oi'), stats: 'Stats'=None):
+        self.workers = max(1, workers)
+        self.command = list(command)
+        self.stats = stats
+
+    def _send(self, addr: str, chunks: Iterable[str]) -> Optional[str]:
+        start = time.perf_counter()
+        try:
+            return self._pipe(addr, chunks)
+        finally:
+            if self.stats: self.stats.record('email', time.perf_counter() - start)
+
+    def _pipe(self, addr: str, chunks: Iterable[str]) -> Optional[str]:
+        try:
+            p = subprocess.Popen(self.command + [addr], stdin=subprocess.PIPE)
+        except OSError as e:
+            return str(e)
+        error = None
+        try:
+            for chunk in chunks:
+                p.stdin.write(chunk.encode())
+        except OSError as e:
+            error = str(e)
+        finally:
+            try:
+                p.stdin.close()
+            except OSError as e:
+                # Flushing fails once sendmail has exited, its return code says why
+                error = error or str(e)
+            p.wait()
+        # Exiting cleanly without reading the whole message still leaves it truncated
+        return error if p.returncode == 0 else f'{self.command[0]} exited with {p.returncode}'
+
+    def deliver(self, messages: Iterable[Message]) -> Iterator[Tuple[str, Optional[str]]]:
+        # Only render a few messages ahead of the pool
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            pending = collections.deque()
+            for addr, chunks in messages:
+                pending.append((addr, executor.submit(self._send, addr, list(chunks))))
+                if len(pending) >= self.workers * 2:
+                    addr, future = pending.popleft()
+                    yield addr, future.result()
+            for addr, future in pending:
+                yield addr, future.result()
+
+class SmtpBackend:
+    '''
+    Send every message over one reused SMTP connection, reconnecting if the server drops it.
+    '''
+    def __init__(self, host: str='localhost', port: int=25, sender: str=None, timeout: float=60, stats: 'Stats'=None):
+        self.host = host
+        self.port = port
+        self.sender = sender or f'{getpass.getuser()}@{socket.getfqdn()}'
+        self.timeout = timeout
+        self.stats = stats
+        self.connection = None
+
+    def _connect(self):
+        self.connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        self.connection.ehlo_or_helo_if_needed()
+
+    def _send(self, addr: str, data: bytes):
+        start = time.perf_counter()
+        try:
+            if self.connection is None: self._connect()
+            try:
+                self.connection.sendmail(self.sender, [addr], data)
+            except smtplib.SMTPServerDisconnected:
+                self._connect()
+                self.connection.sendmail(self.sender, [addr], data)
+        finally:
+            if self.stats: self.stats.record('email', time.perf_counter() - start)
+
+    def deliver(self, messages: Iterable[Message]) -> Iterator[Tuple[str, Optional[str]]]:
+        try:
+            for addr, chunks in messages:
+                # Headers are written with bare newlines, SMTP wants CRLF
+                data = ''.join(chunks).replace('\r\n', '\n').replace('\n', '\r\n').encode()
+                try:
+                    self._send(addr, data)
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as e:
+                    # Only this message was rejected, the connection is still usable
+                    yield addr, str(e)
+                    continue
+                except OSError as e:
+                    if self.connection is not None: self.connection.close()
+                    self.connection = None
+                    yield addr, str(e)
+                    continue
+                yield addr, None
+        finally:
+            if self.connection is not None:
+                try:
+                    self.connection.quit()
+                except OSError:
+                    pass
+                self.connection = None
@@ -0,0 +1,68 @@
+import pwd, logging, functools, threading, concurrent.futures
+from typing import Callable, Dict, Iterable, Optional
+
+'''
+Resolve uids to usernames without a directory service lookup per node.
+'''
+
+class OwnerResolver:
+    '''
+    Enumerates the passwd database once, then falls back to individually cached lookups for
+    uids it did not list (e.g. LDAP/SSSD without enumeration). Enumeration or a lookup taking
+    longer than timeout seconds disables further lookups, so a hung directory service cannot
+    stall a run, and is left running on a daemon thread so it cannot hold up exit either.
+    '''
+    def __init__(self, enumerate: bool=True, cache_size: int=4096, timeout: float=5):
+        self.enumerate = enumerate
+        self.timeout = timeout
+        self.names = None
+        self.available = True
+        self._lookup = functools.lru_cache(maxsize=cache_size)(self._lookup_uncached)
+
+    def _load(self):
+        self.names = {}
+        if self.enumerate:
+            try:
+                for entry in self._call(pwd.getpwall) or ():
+                    self.names.setdefault(entry.pw_uid, entry.pw_name)
+            except OSError:
+                logging.exception('Failed to enumerate users')
+
+    def _lookup_uncached(self, uid: int) -> Optional[str]:
+        try:
+            entry = self._call(pwd.getpwuid, uid)
+        except KeyError:
+            return None
+        return entry.pw_name if entry is not None else None
+
+    def _call(self, func: Callable, *args):
+        # None once a call has timed out
+        if not self.available: return None
+        future = concurrent.futures.Future()
+        def _run():
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+        threading.Thread(target=_run, daemon=True).start()
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            logging.warning(f'Owner lookup disabled, {func.__name__} took over {self.timeout}s, owners are left unresolved')
+            self.available = False
+            return None
+
+    def get_name(self, uid: int, default: Optional[str]=None) -> Optional[str]:
+        '''
+        Username of a uid, or default if it has none.
+        '''
+        if self.names is None: self._load()
+        name = self.names.get(uid)
+        if name is None: name = self._lookup(uid)
+        return default if name is None else name
+
+    def get_names(self, uids: Iterable[int], default: Optional[str]=None) -> Dict[int, Optional[str]]:
+        '''
+        Usernames of many uids, each distinct uid looked up once.
+        '''
+        return {uid: self.get_name(uid, default) for uid in set(uids)}
@@ -0,0 +1,109 @@
+import asyncio, threading, contextlib, concurrent.futures
+from typing import Callable, Iterator, List
+
+from scan_unused.core import Node, Tree
+from scan_unused.walk import walk
+
+'''
+Scan and act concurrently. Each top-level entry is complete, with its size and access time
+propagated, as soon as the walk moves on to the next one, so it can be deleted while the
+rest of the directory is still being walked.
+'''
+
+class Pipeline:
+    '''
+    Walk dir and hand the unused nodes of each finished top-level entry to act, which runs on
+    its own thread while walking continues. At most max_pending finished entries wait for act
+    before walking pauses, bounding memory when acting is slower than scanning.
+    collect, if given, is called on the act thread with the tree of every top-level entry.
+    '''
+    def __init__(self, dir: str, days: int, act: Callable[[List[Node]], int], collect: Callable[[Tree], None]=None, workers: int=1, skip: str=None,
+                 max_pending: int=4, stats: 'Stats'=None, rules: 'Rules'=None, backend: str='scandir'):
+        self.dir = dir
+        self.days = days
+        self.act = act
+        self.collect = collect
+        self.workers = workers
+        self.skip = skip
+        self.max_pending = max(1, max_pending)
+        self.stats = stats
+        self.rules = rules
+        self.backend = backend
+
+    def iter_subtrees(self, stop: threading.Event=None) -> Iterator[Tree]:
+        '''
+        Iterate a tree per top-level entry, each rooted at dir with that entry as its only child.
+        Once stop is set, walking ends at the next record, dropping the entry being walked.
+        '''
+        records = walk(self.dir, self.workers, stats=self.stats, rules=self.rules, backend=self.backend)
+        try:
+            root = next(records)
+            group = None
+            for record in records:
+                if stop is not None and stop.is_set(): return
+                if record[0] == 1:
+                    if group: yield Tree.from_records(group)
+                    group = [root, record] if record[1] != self.skip else None
+                elif group:
+                    group.append(record)
+            if group: yield Tree.from_records(group)
+        finally:
+            records.close()
+
+    def _next(self, subtrees: Iterator[Tree], parent: str) -> Tree:
+        if self.stats is None: return next(subtrees, None)
+        with self.stats.phase('scan', parent):
+            return next(subtrees, None)
+
+    def _act_on(self, tree: Tree, parent: str) -> int:
+        # Phases of act and collect nest in this one
+        with self.stats.phase('act', parent) if self.stats else contextlib.nullcontext():
+            if self.collect: self.collect(tree)
+            nodes = list(tree.iter_nodes_unused(self.days))
+            return self.act(nodes) if nodes else 0
+
+    async def run_async(self) -> int:
+        '''
+        Run the pipeline, returning the sum of what act returned.
+        If act fails, walking stops at the next record and the error is raised.
+        '''
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.max_pending)
+        # The scan thread cannot be cancelled, so it is told to stop walking instead
+        stop = threading.Event()
+        subtrees = self.iter_subtrees(stop)
+        # Phases on the scan and act threads nest in the caller's
+        parent = self.stats.get_phase() if self.stats else None
+        total = 0
+
+        async def _scan():
+            while True:
+                # Walking blocks, so each step runs on the scan thread
+                tree = await loop.run_in_executor(scan_executor, self._next, subtrees, parent)
+                await queue.put(tree)
+                if tree is None: return
+                if self.stats: self.stats.add('pipeline_subtrees')
+
+        async def _act():
+            nonlocal total
+            while True:
+                tree = await queue.get()
+                if tree is None: return
+                total += await loop.run_in_executor(act_executor, self._act_on, tree, parent)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(1) as scan_executor, concurrent.futures.ThreadPoolExecutor(1) as act_executor:
+                tasks = [asyncio.ensure_future(_scan()), asyncio.ensure_future(_act())]
+                try:
+                    await asyncio.gather(*tasks)
+                finally:
+                    stop.set()
+                    for task in tasks: task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # Only closed once the scan thread is done with it
+            subtrees.close()
+        return total
+
+    def run(self) -> int:
+        return asyncio.run(self.run_async())
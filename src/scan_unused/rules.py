@@ -0,0 +1,105 @@
+import re, pwd, fnmatch
+from typing import List, Optional
+
+'''
+Exclude and protect rules applied while walking. Excluded entries are left out of the tree
+without being descended into, but the folder holding them is protected so they are never
+deleted along with it. Protected entries (and everything below them) are treated as accessed in
+the far future, so neither they nor any folder containing them is ever unused.
+
+Rules files have one rule per line, blank lines and lines starting with # are ignored:
+    exclude glob .snapshot
+    exclude regex ^/scratch/[^/]+/[.]cache$
+    protect owner root
+    protect size >100G
+    protect glob /scratch/shared/reference/*
+Globs containing / match the full path, otherwise only the name.
+'''
+
+EXCLUDE, PROTECT = 'exclude', 'protect'
+
+# Added to the access time of protected entries, putting them after any cutoff while keeping
+# their own access time, which snapshots store instead (3000-01-01 UTC)
+PROTECTED = 32503680000.0
+
+_SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40, 'P': 1 << 50}
+
+def protect(last_access: float) -> float:
+    return last_access if last_access >= PROTECTED else PROTECTED + max(last_access, 0)
+
+def unprotect(last_access: float) -> float:
+    return last_access - PROTECTED if last_access >= PROTECTED else last_access
+
+class Rule:
+    '''
+    Single glob, regex, owner or size condition. Glob and regex rules only need the path.
+    '''
+    __slots__ = ('action', 'kind', 'value', 'match_path', 'needs_stat')
+
+    def __init__(self, action: str, kind: str, value: str):
+        if action not in (EXCLUDE, PROTECT):
+            raise ValueError(f'Unknown rule action "{action}"')
+        self.action = action
+        self.kind = kind
+        self.match_path = '/' in value
+        self.needs_stat = kind in ('owner', 'size')
+        if kind == 'glob':
+            self.value = re.compile(fnmatch.translate(value))
+        elif kind == 'regex':
+            self.value = re.compile(value)
+        elif kind == 'owner':
+            self.value = int(value) if value.isdigit() else pwd.getpwnam(value).pw_uid
+        elif kind == 'size':
+            m = re.fullmatch(r'([<>])\s*(\d+)\s*([KMGTP]?)i?B?', value.strip(), re.IGNORECASE)
+            if not m: raise ValueError(f'Invalid size "{value}", expected e.g. >10G or <1K')
+            self.value = (m.group(1), int(m.group(2)) * _SIZE_UNITS[m.group(3).upper()])
+        else:
+            raise ValueError(f'Unknown rule kind "{kind}"')
+
+    def matches(self, path: str, name: str, is_folder: bool=False, owner: int=None, size: int=None) -> bool:
+        if self.kind == 'glob':
+            return bool(self.value.match(path if self.match_path else name))
+        if self.kind == 'regex':
+            return bool(self.value.search(path))
+        if self.kind == 'owner':
+            return owner == self.value
+        # Folder sizes are only known after the walk, so size rules only apply to files
+        op, limit = self.value
+        return not is_folder and (size > limit if op == '>' else size < limit)
+
+class Rules:
+    '''
+    Ordered exclude and protect rules, excludes taking precedence.
+    '''
+    def __init__(self, rules: List[Rule]=()):
+        self.exclude = [r for r in rules if r.action == EXCLUDE]
+        self.protect = [r for r in rules if r.action == PROTECT]
+        self.exclude_paths = [r for r in self.exclude if not r.needs_stat]
+
+    @classmethod
+    def load(cls, path: str) -> 'Rules':
+        rules = []
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'): continue
+                try:
+                    action, kind, value = line.split(None, 2)
+                    rules.append(Rule(action, kind, value))
+                except (ValueError, KeyError) as e:
+                    raise ValueError(f'{path}:{number}: {e}') from e
+        return cls(rules)
+
+    def skips(self, path: str, name: str) -> bool:
+        '''
+        Whether an entry is excluded by its path alone, so it need not be stat'd.
+        '''
+        return any(r.matches(path, name) for r in self.exclude_paths)
+
+    def match(self, path: str, name: str, is_folder: bool, owner: int, size: int) -> Optional[str]:
+        '''
+        EXCLUDE, PROTECT or None for a listed entry.
+        '''
+        if any(r.matches(path, name, is_folder, owner, size) for r in self.exclude): return EXCLUDE
+        if any(r.matches(path, name, is_folder, owner, size) for r in self.protect): return PROTECT
+        return None
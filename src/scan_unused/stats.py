@@ -0,0 +1,123 @@
+import sys, time, json, threading, contextlib, resource
+from typing import Dict, Iterator, List, Optional
+
+'''
+Counters and timings for a single run, so a slow night can be traced to a phase.
+'''
+
+class Stats:
+    '''
+    Thread-safe collection of phase wall times, counters and latency samples.
+    A phase started within another is recorded as "outer/inner", so only phases at the same
+    level are disjoint.
+    '''
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+        self.latencies = {}
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_stack(self) -> List[str]:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None: stack = self._local.stack = []
+        return stack
+
+    def get_phase(self) -> Optional[str]:
+        '''
+        Full name of the innermost phase running on this thread, if any.
+        '''
+        stack = self._get_stack()
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def phase(self, name: str, parent: str=None) -> Iterator[None]:
+        '''
+        Add the wall time of the block to the named phase, nested in the phase running on this
+        thread or else in parent, e.g. a get_phase from the thread that handed over the work.
+        '''
+        stack = self._get_stack()
+        parent = stack[-1] if stack else parent
+        name = f'{parent}/{name}' if parent else name
+        stack.append(name)
+        with self.lock:
+            # Listed in the order phases start, so before any nested in them
+            self.phases.setdefault(name, 0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                self.phases[name] += elapsed
+
+    @staticmethod
+    def _get_total(phases: Dict[str, float], name: str) -> float:
+        # Wherever it was nested
+        return sum(seconds for full, seconds in phases.items() if full.rsplit('/', 1)[-1] == name)
+
+    def add(self, name: str, value: int=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, name: str, seconds: float):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+    @staticmethod
+    def get_percentiles(samples: List[float]) -> Dict[str, float]:
+        '''
+        Nearest-rank percentiles of a list of samples.
+        '''
+        ordered = sorted(samples)
+        result = {'count': len(ordered)}
+        for name, p in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)):
+            result[name] = ordered[max(0, -(-p * len(ordered) // 100) - 1)]
+        return result
+
+    @staticmethod
+    def get_peak_rss() -> Dict[str, int]:
+        '''
+        Peak resident set size in bytes of this process and of its finished children.
+        '''
+        # Linux reports kilobytes, macOS bytes
+        unit = 1 if sys.platform == 'darwin' else 1024
+        return {
+            'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit,
+        }
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            phases, counters = dict(self.phases), dict(self.counters)
+            latencies = {name: self.get_percentiles(samples) for name, samples in self.latencies.items()}
+        rates = {}
+        scan, delete = self._get_total(phases, 'scan'), self._get_total(phases, 'delete')
+        if scan and 'entries_listed' in counters:
+            rates['entries_listed_per_second'] = counters['entries_listed'] / scan
+        if counters.get('entries_listed') and 'stat_calls' in counters:
+            rates['stat_calls_per_entry'] = counters['stat_calls'] / counters['entries_listed']
+        if counters.get('directories_listed') and 'directory_reads' in counters:
+            rates['directory_reads_per_dir'] = counters['directory_reads'] / counters['directories_listed']
+        if delete and 'deleted_entries' in counters:
+            rates['deleted_entries_per_second'] = counters['deleted_entries'] / delete
+        return {'phases': phases, 'counters': counters, 'rates': rates, 'latencies': latencies, 'peak_rss_bytes': self.get_peak_rss()}
+
+    def write_json(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write('\n')
+
+    def format(self) -> str:
+        '''
+        Summary for printing at the end of a run.
+        '''
+        data = self.to_dict()
+        lines = [f'{name:<24} {seconds:>10.2f}s' for name, seconds in data['phases'].items()]
+        lines += [f'{name:<24} {value:>11}' for name, value in data['counters'].items()]
+        lines += [f'{name:<24} {value:>11.2f}' for name, value in data['rates'].items()]
+        for name, p in data['latencies'].items():
+            lines.append(f'{name + " latency":<24} ' + ', '.join(f'{k} {p[k] * 1000:.0f}ms' for k in ('p50', 'p90', 'p99', 'max')))
+        lines += [f'{"peak rss " + name:<24} {value / (1 << 20):>10.0f}M' for name, value in data['peak_rss_bytes'].items()]
+        return '\n'.join(lines)
@@ -1,4 +1,40 @@
-import os, datetime
+import os, datetime, collections, threading
+from typing import Callable, Hashable, Optional
+
+DAY = 24 * 60 * 60
+
+class PathCache:
+    '''
+    Bounded cache of folder paths. A path is joined onto its nearest cached ancestor, so nodes
+    sharing folders (e.g. printed or deleted in tree order) do not each rebuild it from the root.
+    Safe to share between threads, e.g. email rendering and deletion workers.
+    '''
+    def __init__(self, size: int=1 << 12):
+        self.size = size
+        self.paths = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_path(self, folder: Hashable, get_parent: Callable[[Hashable], Optional[Hashable]], get_name: Callable[[Hashable], str]) -> str:
+        '''
+        Path of folder, following get_parent until None, caching it and each uncached ancestor.
+        '''
+        with self.lock:
+            paths = self.paths
+            missing = []
+            path = None
+            while folder is not None:
+                path = paths.get(folder)
+                if path is not None:
+                    paths.move_to_end(folder)
+                    break
+                missing.append(folder)
+                folder = get_parent(folder)
+            for folder in reversed(missing):
+                path = os.path.join(path, get_name(folder)) if path is not None else get_name(folder)
+                paths[folder] = path
+            while len(paths) > self.size:
+                paths.popitem(last=False)
+            return path
 
 def get_days_ago_str(last_access: float) -> int:
     '''
@@ -0,0 +1,275 @@
+import os, stat, threading, collections, zlib
+from typing import Callable, Iterator, List, Tuple
+
+from scan_unused import linux
+from scan_unused.rules import EXCLUDE, PROTECT, protect, unprotect
+
+'''
+Directory walker shared by the tree builders. Directories are scanned by a pool of
+threads that each work depth-first on their own deque and steal from others when idle,
+while the caller consumes results in a deterministic pre-order.
+'''
+
+# (depth, name, is_folder, owner, size, last_access, change_time), the root comes first with depth 0
+Record = Tuple[int, str, bool, int, int, float, float]
+
+_PENDING, _CLAIMED, _DONE = range(3)
+
+SCAN_BACKENDS = ('scandir', 'statx')
+
+class _Job:
+    '''
+    A single directory to be scanned, filled with entries once done.
+    '''
+    __slots__ = ('path', 'state', 'entries', 'by_worker', 'change_time', 'previous', 'protected', 'pinned')
+
+    def __init__(self, path: str, change_time: float, previous: int, protected: bool=False):
+        self.path = path
+        self.state = _PENDING
+        self.entries = None
+        self.by_worker = False
+        self.change_time = change_time
+        self.previous = previous
+        self.protected = protected
+        self.pinned = False
+
+def scan_dir(path: str, on_error: Callable[[OSError], None]=None, skip: Callable[[str, str], bool]=None, counts: List[int]=None) -> List[tuple]:
+    '''
+    List a directory as (name, is_folder, owner, size, last_access, change_time) tuples.
+    Errors stop the listing early, keeping whatever was already read, and are passed to on_error.
+    Entries for which skip(path, name) is true are left out without being stat'd.
+    counts, if given, is a [stat calls, directory reads] list added to, reads are not known here.
+    '''
+    entries = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if skip and skip(entry.path, entry.name): continue
+                # The type comes from the lstat itself, so symlinks are never followed
+                stats = entry.stat(follow_symlinks=False)
+                if counts is not None: counts[0] += 1
+                if stat.S_ISDIR(stats.st_mode):
+                    # Folders use mtime (but non-empty will get overwritten in propagation)
+                    entries.append((entry.name, True, stats.st_uid, 0, stats.st_mtime, stats.st_ctime))
+                else:
+                    # Files use atime
+                    entries.append((entry.name, False, stats.st_uid, stats.st_size, stats.st_atime if not stat.S_ISLNK(stats.st_mode) else stats.st_mtime, stats.st_ctime))
+    except OSError as e:
+        if on_error: on_error(e)
+    return entries
+
+def get_scan_dir(backend: str='scandir') -> Callable[..., List[tuple]]:
+    '''
+    Listing function for a backend: scandir anywhere, or getdents64 and statx on Linux.
+    '''
+    if backend == 'scandir': return scan_dir
+    if backend == 'statx':
+        if not linux.available(): raise ValueError('The statx backend needs Linux with glibc 2.30 or later')
+        return linux.scan_dir
+    raise ValueError(f'Unknown scan backend "{backend}"')
+
+def get_shard(name: str, count: int) -> int:
+    '''
+    Shard a top-level entry belongs to, the same on every host and run.
+    '''
+    return zlib.crc32(os.fsencode(name)) % count
+
+class Walker:
+    '''
+    Work-stealing pool of directory scanners. With a single worker everything is scanned
+    lazily on the calling thread.
+
+    Given a previous tree, directories whose ctime is unchanged are not listed again: their
+    cached files are reused and only their subfolders are stat'd. Records then carry the
+    index of the matching node in the previous tree as an extra last field (-1 if new).
+
+    Given a shard (index, count), only top-level entries in that shard are walked.
+    Given stats, directories and entries listed and listing errors are counted.
+    Given rules, excluded entries are left out and protected ones, with everything below
+    them, are given an access time in the far future (see rules.protect). Folders holding
+    excluded entries are protected themselves, so their records only come once listed.
+    Cached access times from a previous tree are never protected, rules decide again.
+    The backend is one of SCAN_BACKENDS, see get_scan_dir.
+    '''
+    def __init__(self, workers: int=1, max_ahead: int=None, previous: 'CompactTree'=None, shard: Tuple[int, int]=None, stats: 'Stats'=None, rules: 'Rules'=None, backend: str='scandir'):
+        self.workers = max(1, workers)
+        self.max_ahead = max_ahead or self.workers * 256
+        self.previous = previous
+        self.shard = shard
+        self.stats = stats
+        self.rules = rules
+        self.scan_dir = get_scan_dir(backend)
+        self.top = None
+        self.deques = [collections.deque() for _ in range(self.workers)]
+        self.cond = threading.Condition()
+        self.ahead = 0
+        self.closed = False
+        self.next_deque = 0
+        self.threads = []
+
+    def _in_shard(self, job: _Job, name: str) -> bool:
+        return not self.shard or job is not self.top or get_shard(name, self.shard[1]) == self.shard[0]
+
+    def _scan_dir(self, job: _Job) -> List[tuple]:
+        skip = None
+        rules = self.rules if self.rules and self.rules.exclude_paths else None
+        if rules or (self.shard and job is self.top):
+            def skip(path, name):
+                # Entries of other shards are never stat'd, nor do they pin the folder
+                if not self._in_shard(job, name): return True
+                if rules is None or not rules.skips(path, name): return False
+                job.pinned = True
+                return True
+        if self.stats is None: return self.scan_dir(job.path, skip=skip)
+        counts = [0, 0]
+        entries = self.scan_dir(job.path, lambda _: self.stats.add('scan_errors'), skip, counts)
+        self.stats.add('directories_listed')
+        self.stats.add('entries_listed', len(entries))
+        self.stats.add('stat_calls', counts[0])
+        if counts[1]: self.stats.add('directory_reads', counts[1])
+        return entries
+
+    def _list(self, job: _Job) -> List[tuple]:
+        previous = self.previous
+        if previous is None or job.previous < 0:
+            return [e + (-1,) for e in self._scan_dir(job)]
+
+        children = list(previous.iter_children(job.previous))
+        if previous.change_time[job.previous] != job.change_time:
+            # Changed listing, but unchanged subfolders can still be reused further down
+            folders = {previous.get_name(c): c for c in children if previous.is_folder[c]}
+            return [e + (folders.get(e[0], -1) if e[1] else -1,) for e in self._scan_dir(job)]
+
+        entries = []
+        for c in children:
+            name = previous.get_name(c)
+            if not self._in_shard(job, name): continue
+            if not previous.is_folder[c]:
+                entries.append((name, False, previous.owner[c], previous.size[c], unprotect(previous.last_access[c]), previous.change_time[c], -1))
+                continue
+            if self.stats: self.stats.add('stat_calls')
+            try:
+                stats = os.stat(os.path.join(job.path, name), follow_symlinks=False)
+            except OSError:
+                if self.stats: self.stats.add('scan_errors')
+                continue
+            if stat.S_ISDIR(stats.st_mode):
+                entries.append((name, True, stats.st_uid, 0, stats.st_mtime, stats.st_ctime, c))
+        return entries
+
+    def _scan(self, job: _Job, own: collections.deque):
+        listed = self._list(job)
+        entries = []
+        for name, is_folder, owner, size, last_access, change_time, previous in listed:
+            path = os.path.join(job.path, name)
+            protected = job.protected
+            if self.rules:
+                action = self.rules.match(path, name, is_folder, owner, size)
+                if action == EXCLUDE:
+                    job.pinned = True
+                    continue
+                protected = protected or action == PROTECT
+            if protected: last_access = protect(last_access)
+            child = _Job(path, change_time, previous, protected) if is_folder else None
+            entries.append((name, is_folder, owner, size, last_access, change_time, previous, child))
+        if self.threads:
+            with self.cond:
+                own.extend(e[7] for e in reversed(entries) if e[7] is not None)
+                self.cond.notify_all()
+        return entries
+
+    def _steal(self, i: int):
+        own = self.deques[i]
+        while own:
+            job = own.pop()
+            if job.state == _PENDING: return job
+        for j in range(1, self.workers):
+            other = self.deques[(i + j) % self.workers]
+            while other:
+                job = other.popleft()
+                if job.state == _PENDING: return job
+        return None
+
+    def _run(self, i: int):
+        own = self.deques[i]
+        while True:
+            with self.cond:
+                job = None
+                while not self.closed:
+                    if self.ahead < self.max_ahead:
+                        job = self._steal(i)
+                        if job: break
+                    self.cond.wait()
+                if self.closed: return
+                job.state = _CLAIMED
+                job.by_worker = True
+                self.ahead += 1
+            entries = self._scan(job, own)
+            with self.cond:
+                job.entries = entries
+                job.state = _DONE
+                self.cond.notify_all()
+
+    def _result(self, job: _Job) -> List[tuple]:
+        run_here = False
+        with self.cond:
+            if job.state == _PENDING:
+                job.state = _CLAIMED
+                run_here = True
+            else:
+                while job.state != _DONE:
+                    self.cond.wait()
+                if job.by_worker:
+                    self.ahead -= 1
+                    self.cond.notify_all()
+        if run_here:
+            own = self.deques[self.next_deque]
+            self.next_deque = (self.next_deque + 1) % self.workers
+            return self._scan(job, own)
+        entries, job.entries = job.entries, None
+        return entries
+
+    def walk(self, path: str) -> Iterator[Record]:
+        '''
+        Yield path and every node below it in pre-order, children in scandir order.
+        '''
+        stats = os.stat(path)
+        if not stat.S_ISDIR(stats.st_mode):
+            raise Exception('Must provide valid directory')
+        previous = 0 if self.previous is not None else -1
+        extra = (previous,) if self.previous is not None else ()
+
+        if self.workers > 1:
+            self.threads = [threading.Thread(target=self._run, args=(i,), daemon=True) for i in range(self.workers)]
+            for t in self.threads: t.start()
+        try:
+            # Rules match full paths, whatever the directory was given as
+            self.top = _Job(os.path.abspath(path), stats.st_ctime, previous)
+            entries = self._result(self.top)
+            yield (0, path, True, stats.st_uid, 0, protect(-1) if self.top.pinned else -1, stats.st_ctime) + extra
+            stack = [iter(entries)]
+            while stack:
+                entry = next(stack[-1], None)
+                if entry is None:
+                    stack.pop()
+                    continue
+                name, is_folder, owner, size, last_access, change_time, previous, child = entry
+                if child is not None:
+                    # Listed first, as excluded entries protect their folder
+                    entries = self._result(child)
+                    if child.pinned: last_access = protect(last_access)
+                yield (len(stack), name, is_folder, owner, size, last_access, change_time) + ((previous,) if extra else ())
+                if child is not None:
+                    stack.append(iter(entries))
+        finally:
+            with self.cond:
+                self.closed = True
+                self.cond.notify_all()
+            for t in self.threads: t.join()
+            self.threads = []
+
+def walk(path: str, workers: int=1, previous: 'CompactTree'=None, shard: Tuple[int, int]=None, stats: 'Stats'=None, rules: 'Rules'=None, backend: str='scandir') -> Iterator[Record]:
+    '''
+    Walk path with the given number of scanning threads, see Walker.walk.
+    '''
+    yield from Walker(workers, previous=previous, shard=shard, stats=stats, rules=rules, backend=backend).walk(path)
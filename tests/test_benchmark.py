@@ -1,25 +1,32 @@
-import tempfile, os, random, contextlib, time
+import tempfile, os, random, contextlib, time, itertools, json, platform, argparse, gc
 
 import pytest
 
 from scan_unused.core import Node, Tree
-from scan_unused.utils import get_deleting_path
+from scan_unused.compact import CompactTree
+from scan_unused.cli import group_largest, load_template, gen_email
+from scan_unused.utils import DAY, PathCache, get_deleting_path
 
 '''
 Use with pytest-memray
 pytest --memray -k benchmark
+
+Timings of the seeded shape benchmarks are written as JSON and can be compared against an earlier run
+SCAN_UNUSED_BENCH_JSON=new.json SCAN_UNUSED_BENCH_BASELINE=old.json pytest -s -k benchmark_shape
+SCAN_UNUSED_BENCH_TOLERANCE sets the slowdown flagged as a regression (default 0.2, i.e. 20%)
+SCAN_UNUSED_BENCH_SCALE multiplies the number of nodes (default 1)
 '''
 
 @contextlib.contextmanager
-def build_synthetic(max_depth, max_children, max_nodes, in_memory=False):
+def build_synthetic(max_depth, max_children, max_nodes, in_memory=False, compact=False, seed=0):
+    random.seed(seed)
     with tempfile.TemporaryDirectory() as temp_dir:
         count = 1
         stack = [temp_dir]
-        node = Node(temp_dir, True, 0)
 
-        # Uses a single stack to DFS a random file tree
+        # Uses a single stack to DFS a random file tree, yielding pre-order records when in memory
         def _recurse():
-            nonlocal count, node  
+            nonlocal count
             path, depth = (os.path.sep.join(stack), len(stack))
 
             # Enforce depth limit, teminate with file
@@ -27,8 +34,7 @@ def build_synthetic(max_depth, max_children, max_nodes, in_memory=False):
                 if count < max_nodes:
                     count += 1
                     if in_memory: 
-                        assert node.name == stack[-1]
-                        node.children.append(Node('file', False, 0, node))
+                        yield depth, 'file', False, 0, 0, -1, 0
                     else: 
                         open(os.path.join(path, 'file'), 'a').close()
             else:
@@ -38,36 +44,219 @@ def build_synthetic(max_depth, max_children, max_nodes, in_memory=False):
                         count += 1
                         path_append = f'really-long-name-{str(child)}'
                         if in_memory:
-                            node.children.append(Node(path_append, True, 0, node))
-                            node = node.children[-1]
+                            yield depth, path_append, True, 0, 0, -1, 0
                         else:
                             os.mkdir(os.path.join(path, path_append))
                         stack.append(path_append)
-                        _recurse()
+                        yield from _recurse()
                         stack.pop()
-                        if in_memory: node = node.parent
-        _recurse()
-        yield Tree(node) if in_memory else Tree.from_dir(temp_dir)
+        tree_cls = CompactTree if compact else Tree
+        if in_memory:
+            yield tree_cls.from_records(itertools.chain([(0, temp_dir, True, 0, 0, -1, 0)], _recurse()))
+        else:
+            for _ in _recurse(): pass
+            yield tree_cls.from_dir(temp_dir)
 
-def test_benchmark_filesystem():
-    # Test 1 million real files/folders - time-bounded
+@pytest.mark.parametrize('workers', [1, 8])
+def test_benchmark_filesystem(workers):
+    # Test 1 million real files/folders - time-bounded, reports deletion throughput
     MAX_NODES = int(1e6)
     with build_synthetic(max_depth=20, max_children=20, max_nodes=MAX_NODES, in_memory=False) as tree:
         assert tree.count_nodes() == MAX_NODES-1
         nodes = list(tree.iter_nodes(lambda _: random.random() > 0.90))
-        tree.delete_nodes(nodes, get_deleting_path(tree.root.name))
+        start = time.perf_counter()
+        removed = tree.delete_nodes(nodes, get_deleting_path(tree.root.name), workers)
+        elapsed = time.perf_counter() - start
+        print(f'Deleted {removed} entries with {workers} workers in {elapsed:.1f}s ({removed / elapsed:.0f}/s)')
 
-@pytest.mark.parametrize('_', range(100))
-def test_benchmark_synthetic_small(_):
+@pytest.mark.parametrize('compact', [False, True])
+@pytest.mark.parametrize('seed', range(100))
+def test_benchmark_synthetic_small(seed, compact):
     # Test 1 thousand to ensure random file tree is reliable - memory-bounded
     MAX_NODES = int(1e3)
-    with build_synthetic(max_depth=20, max_children=20, max_nodes=MAX_NODES, in_memory=True) as tree:
+    with build_synthetic(max_depth=20, max_children=20, max_nodes=MAX_NODES, in_memory=True, compact=compact, seed=seed) as tree:
         assert tree.count_nodes() == MAX_NODES-1
         _ = list(tree.iter_nodes(lambda _: random.random() > 0.90))
 
-def test_benchmark_synthetic_large():
-    # Test 10 million virtual files/folders - memory-bounded
+@pytest.mark.parametrize('compact', [False, True])
+def test_benchmark_synthetic_large(compact):
+    # Test 10 million virtual files/folders - memory-bounded, compare Node objects with columnar store
     MAX_NODES = int(1e7)
-    with build_synthetic(max_depth=20, max_children=20, max_nodes=MAX_NODES, in_memory=True) as tree:
+    with build_synthetic(max_depth=20, max_children=20, max_nodes=MAX_NODES, in_memory=True, compact=compact) as tree:
+        start = time.perf_counter()
+        if compact: tree.propagate()
+        propagated = time.perf_counter()
         assert tree.count_nodes() == MAX_NODES-1
-        _ = list(tree.iter_nodes(lambda _: random.random() > 0.90))
\ No newline at end of file
+        counted = time.perf_counter()
+        _ = list(tree.iter_nodes(lambda _: random.random() > 0.90))
+        print(f'Propagated in {propagated - start:.2f}s, counted in {counted - propagated:.2f}s, iterated in {time.perf_counter() - counted:.2f}s')
+
+def _uncached_path(node):
+    # Path built by following parents to the root, as before folder paths were cached
+    if isinstance(node, Node): return node.get_path()
+    tree, index, full_list = node.tree, node.index, []
+    while index >= 0:
+        full_list.append(tree.get_name(index))
+        index = tree.parent[index]
+    return os.path.join(*reversed(full_list))
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_benchmark_paths(compact):
+    # Build the path of every one of 1 million virtual nodes in tree order, without and with cached folder paths
+    MAX_NODES = int(1e6)
+    with build_synthetic(max_depth=20, max_children=20, max_nodes=MAX_NODES, in_memory=True, compact=compact) as tree:
+        nodes, stack = [], [tree.root]
+        while stack:
+            nodes.append(stack.pop())
+            stack.extend(reversed(nodes[-1].children or []))
+        timings, paths = [], PathCache()
+        for get_path in (_uncached_path, lambda node: node.get_path(paths)):
+            start = time.perf_counter()
+            built = [get_path(node) for node in nodes]
+            timings.append(time.perf_counter() - start)
+            assert len(built) == MAX_NODES
+        assert built[:1000] == [_uncached_path(node) for node in nodes[:1000]]
+        print(f'Built {len(nodes)} paths in {timings[0]:.1f}s uncached, {timings[1]:.1f}s cached ({timings[0] / timings[1]:.1f}x)')
+
+# Folders below each depth and files in each folder, and whether files are small
+SHAPES = {
+    # Few huge directories, e.g. dumps of per-sample outputs
+    'wide': (lambda rng, depth: 50 if depth == 0 else 0, lambda rng, depth: 4000 if depth else 0, False),
+    # Long chains, e.g. nested build or package trees
+    'deep': (lambda rng, depth: 400 if depth == 0 else int(depth < 250), lambda rng, depth: 1, False),
+    # Balanced tree of many tiny files, e.g. source checkouts or conda environments
+    'tiny': (lambda rng, depth: 8 if depth < 4 else 0, lambda rng, depth: 40, True),
+    # Irregular tree of mixed sizes
+    'mixed': (lambda rng, depth: 30 if depth == 0 else rng.randint(1, 5) if depth < 10 else 0, lambda rng, depth: rng.randint(0, 20), False),
+}
+SHAPE_OWNERS = 50
+SHAPE_NODES = int(2e5 * float(os.environ.get('SCAN_UNUSED_BENCH_SCALE', 1)))
+
+def shape_records(shape, max_nodes, seed=0, now=None):
+    '''
+    Pre-order records of a seeded tree of the given shape, with owners, sizes and access times spread over a month.
+    '''
+    rng = random.Random(seed)
+    now = now or time.time()
+    subdirs, files, small = SHAPES[shape]
+
+    def _attrs(is_folder):
+        size = 0 if is_folder else rng.randrange(4096) if small else int(rng.lognormvariate(10, 2))
+        return 1000 + rng.randrange(SHAPE_OWNERS), size, now - rng.random() * 30 * DAY, 0
+
+    yield (0, 'root', True, 1000, 0, -1, 0)
+    count = 1
+    # Open folders as [depth, subfolders left to create, None until their files are written]
+    stack = [[0, None]]
+    while stack:
+        entry = stack[-1]
+        depth = entry[0]
+        if entry[1] is None:
+            for i in range(files(rng, depth)):
+                if count >= max_nodes: return
+                count += 1
+                yield (depth + 1, f'file-{i}', False) + _attrs(False)
+            entry[1] = subdirs(rng, depth)
+        if not entry[1]:
+            stack.pop()
+            continue
+        if count >= max_nodes: return
+        count += 1
+        entry[1] -= 1
+        yield (depth + 1, f'dir-{entry[1]}', True) + _attrs(True)
+        stack.append([depth + 1, None])
+
+def materialise(records, temp_dir):
+    '''
+    Create records below temp_dir as sparse files with their sizes and access times.
+    '''
+    stack = []
+    for depth, name, is_folder, _, size, last_access, _ in records:
+        if depth == 0:
+            stack = [temp_dir]
+            continue
+        del stack[depth:]
+        path = os.path.join(stack[-1], name)
+        if is_folder:
+            os.mkdir(path)
+            stack.append(path)
+        else:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+            os.utime(path, (last_access, last_access))
+
+_results = {}
+
+@pytest.fixture(scope='module')
+def _bench():
+    '''
+    Record the best of repeated timings under a name, written out once the module finishes.
+    '''
+    def _measure(name, fn, repeat=1):
+        best = None
+        for _ in range(repeat):
+            # Like timeit, keep collections of earlier garbage out of the timing
+            gc.collect()
+            gc.disable()
+            try:
+                start = time.perf_counter()
+                result = fn()
+                elapsed = time.perf_counter() - start
+            finally:
+                gc.enable()
+            best = elapsed if best is None else min(best, elapsed)
+        _results[name] = best
+        print(f'{name}: {best:.3f}s')
+        return result
+    yield _measure
+    path = os.environ.get('SCAN_UNUSED_BENCH_JSON')
+    if path and _results:
+        with open(path, 'w') as f:
+            json.dump({'python': platform.python_version(), 'nodes': SHAPE_NODES, 'results': _results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+@pytest.mark.parametrize('shape', list(SHAPES))
+def test_benchmark_shape_memory(shape, _bench):
+    now = time.time()
+    records = list(shape_records(shape, SHAPE_NODES, now=now))
+    tree = _bench(f'{shape}.build', lambda: CompactTree.from_records(records))
+    assert len(tree) == len(records)
+    _bench(f'{shape}.propagate', tree.propagate, 5)
+    _bench(f'{shape}.range', lambda: [list(tree.iter_nodes_range((None, now - days * DAY))) for days in (3, 7, 14)], 5)
+    _bench(f'{shape}.index', lambda: tree.build_index(now), 5)
+    _bench(f'{shape}.range_indexed', lambda: [list(tree.iter_nodes_unused(days)) for days in (3, 7, 14)], 5)
+    _bench(f'{shape}.forecast', lambda: tree.forecast(14, 7, now), 5)
+    _bench(f'{shape}.node_build', lambda: Tree.from_records(records))
+
+    args = argparse.Namespace(email_domain='localhost', email_days=None, email_limit=50, days=14)
+    def _render():
+        template = load_template()
+        groups = group_largest(tree.iter_nodes_unused(14), args.email_limit)
+        return sum(len(''.join(gen_email(template, tree.root.name, group, str(owner), args)[1])) for owner, group in groups.items())
+    assert _bench(f'{shape}.email', _render, 3) > 0
+
+@pytest.mark.parametrize('shape', list(SHAPES))
+def test_benchmark_shape_disk(shape, _bench):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        records = list(shape_records(shape, SHAPE_NODES // 10))
+        materialise(records, temp_dir)
+        tree = _bench(f'{shape}.scan', lambda: CompactTree.from_dir(temp_dir))
+        assert len(tree) == len(records)
+        tree.build_index()
+        nodes = list(tree.iter_nodes_unused(14))
+        _bench(f'{shape}.delete', lambda: tree.delete_nodes(nodes, get_deleting_path(temp_dir)))
+
+def test_benchmark_shape_baseline():
+    # Runs after the shape benchmarks above, comparing with a previous run's JSON
+    path = os.environ.get('SCAN_UNUSED_BENCH_BASELINE')
+    if not path or not _results: pytest.skip('no baseline or results to compare')
+    with open(path) as f:
+        baseline = json.load(f)['results']
+    tolerance = float(os.environ.get('SCAN_UNUSED_BENCH_TOLERANCE', 0.2))
+    regressions = []
+    for name, seconds in sorted(_results.items()):
+        if name not in baseline: continue
+        ratio = seconds / baseline[name] if baseline[name] else 1
+        print(f'{name}: {baseline[name]:.3f}s -> {seconds:.3f}s ({ratio:.2f}x)')
+        if ratio > 1 + tolerance: regressions.append(f'{name} {ratio:.2f}x slower')
+    assert not regressions, ', '.join(regressions)
@@ -0,0 +1,115 @@
+import pytest, socketserver, threading, tempfile, os, sys, argparse
+
+from scan_unused.mail import SendmailBackend, SmtpBackend
+from scan_unused.cli import group_largest, load_template, gen_email
+from scan_unused.core import Node
+
+class _DebuggingSMTPHandler(socketserver.StreamRequestHandler):
+    '''
+    Minimal SMTP server recording messages, refusing recipients starting with "bad".
+    '''
+    def _reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        self.server.connections += 1
+        self._reply('220 localhost')
+        rcpt = None
+        while True:
+            line = self.rfile.readline().decode().rstrip('\r\n')
+            command = line[:4].upper()
+            if not line or command == 'QUIT':
+                self._reply('221 bye')
+                return
+            elif command in ('EHLO', 'HELO'):
+                self._reply('250 localhost')
+            elif command == 'RCPT':
+                rcpt = line.split(':', 1)[1].strip('<> ')
+                self._reply('550 no such user' if rcpt.startswith('bad') else '250 ok')
+            elif command == 'DATA':
+                self._reply('354 go ahead')
+                data = []
+                while True:
+                    data_line = self.rfile.readline().decode()
+                    if data_line == '.\r\n': break
+                    data.append(data_line)
+                self.server.messages.append((rcpt, ''.join(data)))
+                self._reply('250 ok')
+            else:
+                self._reply('250 ok')
+
+@pytest.fixture
+def _smtp_server():
+    server = socketserver.ThreadingTCPServer(('localhost', 0), _DebuggingSMTPHandler)
+    server.messages, server.connections = [], 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def _messages(addrs):
+    for addr in addrs:
+        yield addr, iter([f'To: {addr}\n', 'Subject: test\n', '\n', f'Hello {addr}\n'])
+
+def test_smtp(_smtp_server):
+    backend = SmtpBackend('localhost', _smtp_server.server_address[1], 'scan-unused@localhost')
+    addrs = ['a@localhost', 'bad@localhost', 'b@localhost']
+    results = dict(backend.deliver(_messages(addrs)))
+    assert results['a@localhost'] is None and results['b@localhost'] is None
+    assert 'no such user' in results['bad@localhost']
+    assert _smtp_server.connections == 1
+    assert [rcpt for rcpt, _ in _smtp_server.messages] == ['a@localhost', 'b@localhost']
+    assert _smtp_server.messages[0][1] == 'To: a@localhost\r\nSubject: test\r\n\r\nHello a@localhost\r\n'
+
+def test_sendmail():
+    with tempfile.TemporaryDirectory() as out_dir:
+        # Stand-in for sendmail writing each message to a file named by its recipient
+        script = f'import sys; addr = sys.argv[1]; open({out_dir!r} + "/" + addr, "w").write(sys.stdin.read()); sys.exit(addr.startswith("bad"))'
+        backend = SendmailBackend(3, [sys.executable, '-c', script])
+        addrs = [f'{i}@localhost' for i in range(10)] + ['bad@localhost']
+        results = dict(backend.deliver(_messages(addrs)))
+        assert sorted(addr for addr, error in results.items() if error) == ['bad@localhost']
+        for addr in addrs:
+            with open(os.path.join(out_dir, addr)) as f:
+                assert f.read() == f'To: {addr}\nSubject: test\n\nHello {addr}\n'
+
+    # sendmail exiting without reading its input reports its return code, not a broken pipe
+    backend = SendmailBackend(2, ['sh', '-c', 'exit 3'])
+    large = [('large@localhost', ['x' * (1 << 20)]), ('small@localhost', ['x'])]
+    assert dict(backend.deliver(large)) == {'large@localhost': 'sh exited with 3', 'small@localhost': 'sh exited with 3'}
+
+    # Messages are rendered on the calling thread
+    rendered = []
+    def _chunks():
+        rendered.append(threading.current_thread())
+        yield 'To: a@localhost\n'
+    assert list(SendmailBackend(2, ['sh', '-c', 'cat >/dev/null']).deliver([('a@localhost', _chunks())])) == [('a@localhost', None)]
+    assert rendered == [threading.current_thread()]
+
+    # Exiting cleanly before reading the whole message is still a failure
+    results = dict(SendmailBackend(1, ['sh', '-c', 'head -c 1 >/dev/null']).deliver([('a@localhost', ['x' * (1 << 20)])]))
+    assert 'Broken pipe' in results['a@localhost']
+
+def test_gen_email():
+    root = Node('/scan', True, 0)
+    nodes = []
+    for i in range(20):
+        node = Node(f'f{i}', False, 1000 + i % 2, root)
+        node.size, node.last_access = (i * 7) % 20, 0
+        nodes.append(node)
+    groups = group_largest(nodes, 3)
+    assert sorted(groups) == [1000, 1001]
+    group = groups[1000]
+    owned = [n for n in nodes if n.owner == 1000]
+    assert group.count == len(owned) and group.size == sum(n.size for n in owned)
+    assert [n.size for n in group.get_nodes()] == sorted((n.size for n in owned), reverse=True)[:3]
+
+    args = argparse.Namespace(email_domain='localhost', email_days=None, email_limit=3, days=3)
+    template = load_template()
+    assert load_template() is template
+    addr, chunks = gen_email(template, root.name, group, 'alice', args)
+    body = ''.join(chunks)
+    assert addr == 'alice@localhost'
+    assert body.startswith('To: alice@localhost\n')
+    assert body.count('<td>/scan/f') == 3 and '...' in body
@@ -1,7 +1,15 @@
-import pytest, tempfile, datetime, os
+import pytest, tempfile, datetime, os, random, pwd, time, threading, itertools, concurrent.futures
 
-from scan_unused.core import Node, Tree
-from scan_unused.utils import set_atime, get_days_ago_str, get_deleting_path
+from scan_unused.core import Node, Tree, get_latest_access
+from scan_unused.compact import CompactTree
+from scan_unused.utils import DAY, PathCache, set_atime, get_days_ago_str, get_deleting_path
+from scan_unused.delete import remove_tree
+from scan_unused.owners import OwnerResolver
+from scan_unused.stats import Stats
+from scan_unused.rules import PROTECT, PROTECTED, Rule, Rules, protect
+from scan_unused.walk import scan_dir
+from scan_unused.pipeline import Pipeline
+from scan_unused import linux, pipeline as pipeline_module
 
 @pytest.fixture
 def _test_dir_fixture(request):
@@ -71,7 +79,7 @@ def test_future(_test_dir_fixture):
     assert nodes[0].get_path() == os.path.join(_test_dir_fixture, 'subfolder')
     assert len(nodes[0].children) == 1
 
-    # There should not be files with atimes in the future
+    # Expiring in 3 days means last accessed within the past day, which no file was
     assert len(list(tree.iter_nodes_unused(3, 3))) == 0
 
 @pytest.mark.parametrize("_test_dir_fixture", [[('.hidden_folder/1.txt', 0), ('.hidden_file.txt', 0)]], indirect=True)
@@ -96,4 +104,447 @@ def test_symlink(_test_dir_fixture):
     tree.delete_nodes(nodes, get_deleting_path(_test_dir_fixture))
 
     assert os.path.exists(_test_dir_fixture)
-    assert not os.path.exists(harmless_symlink)
\ No newline at end of file
+    assert not os.path.exists(harmless_symlink)
+
+@pytest.mark.parametrize("_test_dir_fixture", [[('a/b/c/1.txt', 2.9), ('a/b/2.txt', 3.1), ('a/d/3.txt', 1), ('e/4.txt', 5), ('5.txt', 0)]], indirect=True)
+def test_workers(_test_dir_fixture):
+    def _flatten(node):
+        return sorted([(node.get_path(), node.is_folder, node.size, node.last_access)] + [x for c in (node.children or []) for x in _flatten(c)])
+    expected = _flatten(Tree.from_dir(_test_dir_fixture).root)
+    for workers in (2, 8):
+        tree = Tree.from_dir(_test_dir_fixture, workers)
+        assert tree.count_nodes() == 10
+        assert _flatten(tree.root) == expected
+
+@pytest.mark.parametrize("_test_dir_fixture", [[('a/b/c/1.txt', 2.9), ('a/b/2.txt', 3.1), ('a/d/3.txt', 1), ('e/4.txt', 5), ('5.txt', 0)]], indirect=True)
+def test_compact(_test_dir_fixture):
+    tree = Tree.from_dir(_test_dir_fixture)
+    compact = CompactTree.from_dir(_test_dir_fixture)
+    assert compact.count_nodes() == tree.count_nodes() == 10
+    assert compact.root.size == tree.root.size
+    assert compact.root.last_access == tree.root.last_access
+    assert sorted(map(repr, compact.iter_nodes(lambda n: not n.is_folder))) == sorted(map(repr, tree.iter_nodes(lambda n: not n.is_folder)))
+    assert sorted(map(repr, compact.iter_nodes_unused(3))) == sorted(map(repr, tree.iter_nodes_unused(3)))
+    assert sorted(map(repr, compact.iter_nodes_unused(3, 1))) == sorted(map(repr, tree.iter_nodes_unused(3, 1)))
+    assert sorted(map(repr, CompactTree.from_tree(tree).iter_nodes(lambda _: True))) == sorted(map(repr, compact.iter_nodes(lambda _: True)))
+
+    nodes = list(compact.iter_nodes_unused(3))
+    assert sorted(n.get_path() for n in nodes) == [os.path.join(_test_dir_fixture, 'a', 'b', '2.txt'), os.path.join(_test_dir_fixture, 'e')]
+    compact.delete_nodes(nodes, get_deleting_path(_test_dir_fixture))
+    assert not os.path.exists(os.path.join(_test_dir_fixture, 'e'))
+    assert not os.path.exists(os.path.join(_test_dir_fixture, 'a', 'b', '2.txt'))
+    assert os.path.exists(os.path.join(_test_dir_fixture, 'a', 'b', 'c', '1.txt'))
+
+@pytest.mark.parametrize("_test_dir_fixture", [[('a/b/c/1.txt', 2.9), ('a/b/2.txt', 3.1), ('a/d/3.txt', 1), ('e/4.txt', 5), ('5.txt', 0)]], indirect=True)
+def test_snapshot(_test_dir_fixture, monkeypatch):
+    tree = CompactTree.from_dir(_test_dir_fixture)
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        snapshot_path = os.path.join(snapshot_dir, 'scan.snap')
+        tree.save(snapshot_path)
+        loaded = CompactTree.load(snapshot_path)
+        assert loaded.scan_time == tree.scan_time
+        assert loaded.count_nodes() == tree.count_nodes() == 10
+        assert loaded.root.get_path() == _test_dir_fixture
+        assert list(map(repr, loaded.iter_nodes(lambda _: True))) == list(map(repr, tree.iter_nodes(lambda _: True)))
+        assert list(map(repr, loaded.iter_nodes_unused(3))) == list(map(repr, tree.iter_nodes_unused(3)))
+        assert list(map(repr, loaded.iter_nodes_unused(3, 1))) == list(map(repr, tree.iter_nodes_unused(3, 1)))
+        assert sorted(c.name for c in loaded.root.children) == ['5.txt', 'a', 'e']
+
+        # Roots given relative to the working directory are saved absolute
+        monkeypatch.chdir(os.path.dirname(_test_dir_fixture))
+        CompactTree.from_dir(os.path.basename(_test_dir_fixture)).save(snapshot_path)
+        loaded = CompactTree.load(snapshot_path)
+        assert loaded.root.name == _test_dir_fixture
+        assert sorted(c.name for c in loaded.root.children) == ['5.txt', 'a', 'e']
+
+@pytest.mark.parametrize("_test_dir_fixture", [[('a/b/c/1.txt', 2.9), ('a/b/2.txt', 3.1), ('a/d/3.txt', 1), ('e/4.txt', 5), ('5.txt', 0), ('f/6.txt', 4), ('7.txt', 6)]], indirect=True)
+def test_shards(_test_dir_fixture, monkeypatch):
+    def _flatten(tree):
+        return sorted((tree.get_path(i), tree.is_folder[i], tree.size[i], tree.last_access[i]) for i in range(len(tree)))
+    tree = CompactTree.from_dir(_test_dir_fixture)
+    for count in (1, 3):
+        parts = [CompactTree.from_dir(_test_dir_fixture, shard=(i, count)) for i in range(count)]
+        assert sum(part.count_nodes() for part in parts) == tree.count_nodes()
+        merged = CompactTree.merge(parts)
+        assert _flatten(merged) == _flatten(tree)
+        assert merged.root.size == tree.root.size and merged.root.last_access == tree.root.last_access
+    # Every shard exactly once, and no top-level entry twice
+    with pytest.raises(Exception, match='1/3 to 3/3'):
+        CompactTree.merge(parts[:2])
+    with pytest.raises(Exception, match='1/3 to 3/3'):
+        CompactTree.merge(parts + parts[:1])
+    with pytest.raises(Exception, match='full scan'):
+        CompactTree.merge([tree] + parts)
+    with pytest.raises(Exception, match='both holding'):
+        CompactTree.merge([tree, tree])
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        snapshot_path = os.path.join(snapshot_dir, 'shard.snap')
+        parts[1].save(snapshot_path)
+        assert CompactTree.load(snapshot_path).shard == (1, 3)
+    stats = Stats()
+    merged = CompactTree.from_dir_sharded(_test_dir_fixture, 2, stats=stats)
+    assert _flatten(merged) == _flatten(tree)
+    merged.build_index()
+    assert sorted(map(repr, merged.iter_nodes_unused(3))) == sorted(map(repr, tree.iter_nodes_unused(3)))
+    # Each shard only stats its own top-level entries
+    assert stats.counters['entries_listed'] == stats.counters['stat_calls'] == tree.count_nodes()
+
+    # The root is named as the directory was given
+    parent, name = os.path.split(_test_dir_fixture)
+    monkeypatch.chdir(parent)
+    assert CompactTree.from_dir_sharded(name, 2).root.name == name
+
+@pytest.mark.parametrize('workers', [1, 4])
+@pytest.mark.parametrize("_test_dir_fixture", [[('a/b/c/1.txt', 5), ('a/b/2.txt', 5), ('a/d/3.txt', 5), ('e/4.txt', 5), ('e/x.tmp', 5), ('5.txt', 5)]], indirect=True)
+def test_rules(_test_dir_fixture, workers, monkeypatch):
+    rules_path = os.path.join(_test_dir_fixture, 'rules')
+    with open(rules_path, 'w') as f:
+        f.write(f'# comment\n\nexclude glob *.tmp\nexclude glob rules\nprotect glob {_test_dir_fixture}/a/b\nprotect size >1T\n')
+    rules = Rules.load(rules_path)
+    for tree_cls in (Tree, CompactTree):
+        tree = tree_cls.from_dir(_test_dir_fixture, workers, rules=rules)
+        names = [n.name for n in tree.iter_nodes(lambda n: not n.is_folder)]
+        assert 'x.tmp' not in names and 'rules' not in names and '4.txt' in names
+        assert tree.count_nodes() == 10
+        if tree_cls is CompactTree: tree.build_index()
+        assert sorted(n.name for n in tree.iter_nodes_unused(3)) == ['4.txt', '5.txt', 'd']
+    assert sorted(n.name for n in Tree.stream_unused(_test_dir_fixture, 3, rules=rules)) == ['4.txt', '5.txt', 'd']
+    # Full path rules still match when the directory is given relative to the current one
+    parent, name = os.path.split(_test_dir_fixture)
+    monkeypatch.chdir(parent)
+    tree = Tree.from_dir(name, workers, rules=rules)
+    assert sorted(n.get_path() for n in tree.iter_nodes_unused(3)) == [os.path.join(name, p) for p in ['5.txt', 'a/d', 'e/4.txt']]
+
+    # Protection is shown as such, and never saved in snapshots or reused by rescans
+    tree = CompactTree.from_dir(_test_dir_fixture, workers, rules=rules)
+    assert repr(next(tree.iter_nodes(lambda n: n.name == 'b'))).endswith(' (protected, 86.0B)')
+    assert sorted(n.name for n in tree.rescan().iter_nodes_unused(3)) == ['5.txt', 'a', 'e']
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        snapshot_path = os.path.join(snapshot_dir, 'snap')
+        tree.save(snapshot_path)
+        loaded = CompactTree.load(snapshot_path)
+        assert sorted(n.name for n in loaded.iter_nodes_unused(3)) == ['5.txt', 'a', 'e']
+        loaded.apply_rules(rules)
+        # Excluded entries are not in the snapshot, so only verifying them keeps their folder
+        nodes = list(loaded.iter_nodes_unused(3))
+        assert sorted(n.name for n in nodes) == ['5.txt', 'd', 'e']
+        before = time.time() - 3 * DAY
+        assert sorted(n.name for n in Tree.verify_nodes(nodes, before, rules=rules)) == ['5.txt', 'd']
+        assert sorted(n.name for n in Tree.verify_nodes(nodes, before)) == ['5.txt', 'd', 'e']
+
+    # Verifying folds the walk into the access time building the tree would give
+    os.mkdir(os.path.join(_test_dir_fixture, 'a', 'empty'))
+    for path in ('', 'a', 'a/b', 'a/empty', 'e'):
+        full = os.path.join(_test_dir_fixture, path)
+        for with_rules in (None, rules):
+            assert get_latest_access(full, workers, with_rules) == Tree.from_dir(full, workers, rules=with_rules).root.last_access
+
+    with open(rules_path, 'w') as f:
+        f.write('protect size 10G\n')
+    with pytest.raises(ValueError, match='rules:1'):
+        Rules.load(rules_path)
+
+@pytest.mark.parametrize("_test_dir_fixture", [[('a/b/c/1.txt', 2.9), ('a/b/2.txt', 3.1), ('a/d/3.txt', 1), ('e/4.txt', 5), ('5.txt', 0)]], indirect=True)
+def test_rescan(_test_dir_fixture):
+    tree = CompactTree.from_dir(_test_dir_fixture)
+    old_access = os.stat(os.path.join(_test_dir_fixture, 'a/b/c/1.txt')).st_atime
+
+    # Changing a file's atime does not change its directory, so the cached value is kept
+    set_atime(os.path.join(_test_dir_fixture, 'a/b/c/1.txt'), datetime.datetime.now(), None)
+    open(os.path.join(_test_dir_fixture, 'a/d/new.txt'), 'w').close()
+    os.remove(os.path.join(_test_dir_fixture, 'e/4.txt'))
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        snapshot_path = os.path.join(snapshot_dir, 'scan.snap')
+        tree.save(snapshot_path)
+        rescanned = CompactTree.load(snapshot_path).rescan(workers=2)
+    fresh = CompactTree.from_dir(_test_dir_fixture)
+
+    assert rescanned.count_nodes() == fresh.count_nodes() == 10
+    assert rescanned.root.size == fresh.root.size
+    cached = [n for n in rescanned.iter_nodes(lambda n: n.name == '1.txt')]
+    assert len(cached) == 1 and cached[0].last_access == old_access
+    assert sorted(map(repr, rescanned.iter_nodes(lambda n: n.name != '1.txt' and not n.is_folder))) == sorted(map(repr, fresh.iter_nodes(lambda n: n.name != '1.txt' and not n.is_folder)))
+    assert {n.name: n.last_access for n in rescanned.iter_nodes(lambda n: n.name in ('d', 'e'))} == {n.name: n.last_access for n in fresh.iter_nodes(lambda n: n.name in ('d', 'e'))}
+
+    # Verifying against the filesystem drops the file that was accessed since
+    two_days_ago = (datetime.datetime.now() - datetime.timedelta(days=2)).timestamp()
+    assert get_days_ago_str(cached[0].last_access) == 2
+    assert list(Tree.verify_nodes(cached, two_days_ago)) == []
+
+def _count_entries(paths):
+    # Every entry at or below each path
+    return sum(1 + sum(len(dirs) + len(files) for _, dirs, files in os.walk(path)) for path in paths)
+
+def _random_records(now, count, seed=0):
+    random.seed(seed)
+    records, max_depth = [(0, 'root', True, 0, 0, -1, 0)], 1
+    for i in range(count):
+        depth = random.randint(1, max_depth)
+        is_folder = random.random() > 0.3
+        records.append((depth, str(i), is_folder, random.randint(0, 3), random.randint(0, 100), now - random.random() * 10 * DAY, 0))
+        max_depth = depth + 1 if is_folder else depth
+    return records
+
+def test_path_cache():
+    records = _random_records(time.time(), 2000)
+    tree, compact = Tree.from_records(records), CompactTree.from_records(records)
+    nodes, stack = [], [tree.root]
+    while stack:
+        nodes.append(stack.pop())
+        stack.extend(nodes[-1].children or [])
+    expected = [n.get_path() for n in nodes]
+
+    # Small caches evict constantly, so paths must not depend on what is still cached
+    cache = PathCache(8)
+    order = random.sample(range(len(nodes)), len(nodes))
+    assert [nodes[i].get_path(cache) for i in order] == [expected[i] for i in order]
+    assert len(cache.paths) <= 8
+    compact.paths = PathCache(8)
+    assert sorted(compact.get_path(i) for i in order) == sorted(expected)
+    # A given cache is used instead of the tree's own
+    compact.paths, cache = PathCache(), PathCache()
+    assert compact.root.children[0].get_path(cache) == tree.root.children[0].get_path()
+    assert list(cache.paths) == [0] and not compact.paths.paths
+
+    # Shared by threads, e.g. rendering emails while deleting
+    cache = PathCache(8)
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        built = list(executor.map(lambda i: nodes[i].get_path(cache), order * 4))
+    assert built == [expected[i] for i in order] * 4
+
+def test_deep_tree():
+    # Far deeper than the recursion limit
+    depth = 5000
+    records = [(0, 'root', True, 0, 0, -1, 0)] + [(d, 'd', True, 0, 0, -1, 0) for d in range(1, depth)] + [(depth, 'f', False, 0, 7, 100, 0)]
+    tree = Tree.from_records(records)
+    assert tree.count_nodes() == depth
+    assert tree.root.size == 7 and tree.root.last_access == 100
+    assert [n.name for n in tree.iter_nodes(lambda n: not n.is_folder)] == ['f']
+
+def test_propagate(monkeypatch):
+    pytest.importorskip('numpy')
+    import scan_unused.compact
+    records = _random_records(time.time(), 10000)
+    # Some folders protected by the walk, which must stay protected
+    records = [r[:5] + (protect(r[5]),) + r[6:] if r[2] and i % 50 == 1 else r for i, r in enumerate(records)]
+    rules = Rules([Rule(PROTECT, 'regex', '/1[0-9]$')])
+    def _build(snapshot_dir):
+        # Loaded trees map their arrays from the snapshot instead of holding them
+        tree = CompactTree.from_records(records)
+        tree.save(os.path.join(snapshot_dir, 'protected.snap'), protected=True)
+        CompactTree.load(os.path.join(snapshot_dir, 'protected.snap')).save(os.path.join(snapshot_dir, 'scan.snap'))
+        loaded = CompactTree.load(os.path.join(snapshot_dir, 'scan.snap'))
+        loaded.apply_rules(rules)
+        return tree, loaded
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        tree, loaded = _build(snapshot_dir)
+        monkeypatch.setattr(scan_unused.compact, 'numpy', None)
+        expected, expected_loaded = _build(snapshot_dir)
+    assert tree.size == expected.size and tree.last_access == expected.last_access
+    assert loaded.size == expected_loaded.size and loaded.last_access == expected_loaded.last_access
+    assert tree.root.size == Tree.from_records(records).root.size
+    assert all(tree.last_access[i] >= PROTECTED for i, r in enumerate(records) if r[2] and i % 50 == 1)
+    assert any(t >= PROTECTED for t in loaded.last_access[1:]) and loaded.last_access[0] >= PROTECTED
+
+def test_index():
+    now = datetime.datetime.now().timestamp()
+    tree = CompactTree.from_records(_random_records(now, 2000))
+    tree.build_index(now)
+
+    day, total = DAY, 0
+    for days in range(1, 8):
+        expected = [n.index for n in tree.iter_nodes_range((None, now - days * day))]
+        assert [n.index for n in tree.iter_nodes_unused(days)] == expected
+        for future in range(1, 8):
+            expected = [n.index for n in tree.iter_nodes_range((now - (days - future + 1) * day, now - (days - future) * day))] if future <= days else []
+            assert [n.index for n in tree.iter_nodes_unused(days, future)] == expected
+            total += len(expected)
+    assert total > 0
+
+@pytest.mark.parametrize('tree_cls', [Tree, CompactTree])
+def test_forecast(tree_cls):
+    now = datetime.datetime.now().timestamp()
+    tree = tree_cls.from_records(_random_records(now, 2000))
+    for days in (1, 3, 7):
+        forecast = tree.forecast(days, 5, now)
+        assert list(forecast.nodes) == list(range(1, min(days, 5) + 1))
+        for day, nodes in forecast.nodes.items():
+            expected = tree.iter_nodes_range((now - (days - day + 1) * DAY, now - (days - day) * DAY))
+            assert sorted(n.get_path() for n in nodes) == sorted(n.get_path() for n in expected)
+            assert forecast.day_totals[day][0] == len(nodes)
+
+            # Every file is freed on its own day
+            files = tree.iter_nodes(lambda n: not n.is_folder and forecast.get_day(n.last_access) == day)
+            assert forecast.day_totals[day][1] == sum(n.size for n in files)
+            assert sum(totals[day][1] for totals in forecast.owner_totals.values() if day in totals) == forecast.day_totals[day][1]
+
+@pytest.mark.parametrize('workers', [1, 4])
+@pytest.mark.parametrize("_test_dir_fixture", [[('a/b/c/1.txt', 0), ('a/b/2.txt', 0), ('a/d/3.txt', 0), ('e/4.txt', 0), ('5.txt', 0)]], indirect=True)
+def test_remove_tree(_test_dir_fixture, workers):
+    keep = os.path.join(_test_dir_fixture, 'e')
+    os.symlink(keep, os.path.join(_test_dir_fixture, 'a', 'b', 'link'))
+    removed = []
+    assert remove_tree(os.path.join(_test_dir_fixture, 'a'), workers, removed.append) == 8
+    assert sum(removed) == 8
+    assert not os.path.exists(os.path.join(_test_dir_fixture, 'a'))
+    assert os.path.exists(os.path.join(keep, '4.txt'))
+
+    # Failing progress stops every worker instead of hanging
+    def _fail(count): raise ValueError('progress failed')
+    with pytest.raises(ValueError, match='progress failed'):
+        remove_tree(keep, workers, _fail)
+
+@pytest.mark.parametrize("_test_dir_fixture", [[('a/b/c/1.txt', 2.9), ('a/b/2.txt', 3.1), ('a/d/3.txt', 4), ('a/d/4.txt', 5), ('e/f/5.txt', 5), ('e/6.txt', 4), ('7.txt', 0), ('8.txt', 3.5)]], indirect=True)
+def test_stream_unused(_test_dir_fixture):
+    os.mkdir(os.path.join(_test_dir_fixture, '.scan-unused-deleting'))
+    expected = sorted((n.get_path(), n.size) for n in Tree.from_dir(_test_dir_fixture).iter_nodes_unused(3) if n.name != '.scan-unused-deleting')
+    assert [p for p, _ in expected] == sorted(os.path.join(_test_dir_fixture, p) for p in ['8.txt', 'a/b/2.txt', 'a/d', 'e'])
+    assert sorted((n.get_path(), n.size) for n in Tree.stream_unused(_test_dir_fixture, 3, skip='.scan-unused-deleting')) == expected
+
+@pytest.mark.parametrize("_test_dir_fixture", [[('a/b/c/1.txt', 2.9), ('a/b/2.txt', 3.1), ('a/d/3.txt', 4), ('a/d/4.txt', 5), ('e/f/5.txt', 5), ('e/6.txt', 4), ('7.txt', 0), ('8.txt', 3.5)]], indirect=True)
+def test_pipeline(_test_dir_fixture, monkeypatch):
+    deleting_path = os.path.join(_test_dir_fixture, '.scan-unused-deleting')
+    os.mkdir(deleting_path)
+    expected = sorted((n.get_path(), n.size) for n in Tree.stream_unused(_test_dir_fixture, 3, skip='.scan-unused-deleting'))
+    future = sorted(n.get_path() for n in Tree.from_dir(_test_dir_fixture).iter_nodes_unused(3, 1) if n.name != '.scan-unused-deleting')
+
+    # Acting lags behind, so walking pauses once max_pending entries are waiting
+    acted, collected, ahead = [], [], []
+    def _collect(tree):
+        time.sleep(0.05)
+        ahead.append(stats.counters['pipeline_subtrees'] - len(ahead))
+        collected.extend(n.get_path() for n in tree.iter_nodes_unused(3, 1))
+    def _act(nodes):
+        acted.extend((n.get_path(), n.size) for n in nodes)
+        return len(nodes)
+    stats = Stats()
+    pipeline = Pipeline(_test_dir_fixture, 3, _act, _collect, skip='.scan-unused-deleting', max_pending=1, stats=stats)
+    assert pipeline.run() == len(expected)
+    assert sorted(acted) == expected and sorted(collected) == future
+    assert stats.counters['pipeline_subtrees'] == len(ahead) == 4 and max(ahead) <= 2
+
+    def _fail(nodes): raise OSError('act failed')
+    with pytest.raises(OSError, match='act failed'):
+        Pipeline(_test_dir_fixture, 3, _fail, skip='.scan-unused-deleting').run()
+
+    # Each batch removes the deleting folder once done
+    entries = _count_entries(path for path, _ in expected)
+    removed = Pipeline(_test_dir_fixture, 3, lambda nodes: Tree.delete_nodes(nodes, get_deleting_path(_test_dir_fixture)), workers=2, skip='.scan-unused-deleting').run()
+    assert removed == entries
+    assert sorted(os.listdir(_test_dir_fixture)) == ['7.txt', 'a']
+    assert sorted(os.listdir(os.path.join(_test_dir_fixture, 'a'))) == ['b']
+
+    # A failure stops walking, even in the middle of an endless top-level entry
+    def _endless(*args, **kwargs):
+        yield from [(0, '/endless', True, 0, 0, -1, 0), (1, 'a', False, 0, 1, 0, 0), (1, 'b', True, 0, 0, -1, 0)]
+        for i in itertools.count():
+            time.sleep(0.001)
+            yield (2, f'{i}', False, 0, 1, 0, 0)
+    monkeypatch.setattr(pipeline_module, 'walk', _endless)
+    with pytest.raises(OSError, match='act failed'):
+        Pipeline('/endless', 3, _fail).run()
+
+@pytest.mark.parametrize('tree_cls', [Tree, CompactTree])
+def test_owner_summary(tree_cls):
+    now = datetime.datetime.now().timestamp()
+    records = _random_records(now, 2000)
+    tree = tree_cls.from_records(records)
+    summary = tree.owner_summary()
+    files = [r for r in records if not r[2]]
+    assert sorted(summary) == sorted(set(r[3] for r in files))
+    for owner, usage in summary.items():
+        assert usage.files == sum(1 for r in files if r[3] == owner)
+        assert usage.size == sum(r[4] for r in files if r[3] == owner)
+        for days in (1, 3, 7):
+            expected = sum(n.size for n in tree.iter_nodes(lambda n: not n.is_folder and n.owner == owner and n.last_access <= now - days * DAY))
+            assert usage.get_unused_size(days) == expected
+
+    # Counting afterwards matches what was collected during the build
+    tree.owners = None
+    counted = tree.owner_summary()
+    assert {o: (u.files, u.size, u.age_sizes) for o, u in counted.items()} == {o: (u.files, u.size, u.age_sizes) for o, u in summary.items()}
+
+def test_owner_resolver(monkeypatch):
+    me = pwd.getpwuid(os.getuid())
+    assert OwnerResolver().get_name(me.pw_uid) == me.pw_name
+
+    # Without enumeration, each uid is looked up once and missing ones fall back
+    calls = []
+    def _getpwuid(uid):
+        calls.append(uid)
+        if uid == me.pw_uid: return me
+        raise KeyError(uid)
+    monkeypatch.setattr(pwd, 'getpwuid', _getpwuid)
+    resolver = OwnerResolver(enumerate=False)
+    assert resolver.get_names([me.pw_uid, 99999, me.pw_uid, 99999], '?') == {me.pw_uid: me.pw_name, 99999: '?'}
+    assert resolver.get_name(99999) is None
+    assert sorted(calls) == [me.pw_uid, 99999]
+
+    # A hung lookup gives up and stops querying
+    monkeypatch.setattr(pwd, 'getpwuid', lambda uid: time.sleep(1))
+    resolver = OwnerResolver(enumerate=False, timeout=0.1)
+    assert resolver.get_name(12345, '?') == '?'
+    assert not resolver.available
+    assert resolver.get_name(12346, '?') == '?'
+
+    # So does enumerating, without a hung thread holding up exit
+    monkeypatch.setattr(pwd, 'getpwall', lambda: time.sleep(1))
+    resolver = OwnerResolver(timeout=0.1)
+    start = time.perf_counter()
+    assert resolver.get_name(me.pw_uid, '?') == '?'
+    assert time.perf_counter() - start < 0.5 and not resolver.available
+    assert all(t.daemon for t in threading.enumerate() if t is not threading.main_thread())
+
+@pytest.mark.parametrize("_test_dir_fixture", [[('a/b/c/1.txt', 2.9), ('a/b/2.txt', 3.1), ('a/d/3.txt', 1), ('e/4.txt', 5), ('5.txt', 0)]], indirect=True)
+def test_stats(_test_dir_fixture):
+    stats = Stats()
+    tree = CompactTree.from_dir(_test_dir_fixture, 2, stats=stats)
+    assert stats.counters['entries_listed'] == tree.count_nodes()
+    assert stats.counters['directories_listed'] == sum(tree.is_folder)
+    assert 'propagate' in stats.phases
+
+    # Nested phases are named after their parent, also when handed to another thread
+    def _act(parent):
+        with stats.phase('act', parent): pass
+    with stats.phase('scan'):
+        CompactTree.from_dir(_test_dir_fixture, stats=stats)
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            executor.submit(_act, stats.get_phase()).result()
+    assert 'scan/propagate' in stats.phases and 'scan/act' in stats.phases and stats.get_phase() is None
+
+    errors = []
+    assert scan_dir(os.path.join(_test_dir_fixture, 'missing'), errors.append) == []
+    assert len(errors) == 1 and isinstance(errors[0], FileNotFoundError)
+
+    nodes = list(tree.iter_nodes_unused(3))
+    entries = _count_entries(n.get_path() for n in nodes)
+    progress = []
+    removed = tree.delete_nodes(nodes, get_deleting_path(_test_dir_fixture), progress=progress.append, stats=stats)
+    # Only entries of the nodes, not the folders they were moved into
+    assert stats.counters['deleted_entries'] == removed == sum(progress) == entries
+    assert stats.counters['deleted_bytes'] == sum(n.size for n in nodes)
+
+    for ms in range(1, 101): stats.record('email', ms / 1000)
+    data = stats.to_dict()
+    assert {k: round(v * 1000) for k, v in data['latencies']['email'].items() if k != 'count'} == {'p50': 50, 'p90': 90, 'p99': 99, 'max': 100}
+    assert data['peak_rss_bytes']['self'] > 0
+
+@pytest.mark.skipif(not linux.available(), reason='needs getdents64 and statx')
+@pytest.mark.parametrize("_test_dir_fixture", [[('a/b/c/1.txt', 2.9), ('a/b/2.txt', 3.1), ('a/d/3.txt', 1), ('e/4.txt', 5), ('5.txt', 0)]], indirect=True)
+def test_statx_backend(_test_dir_fixture):
+    os.symlink(os.path.join(_test_dir_fixture, 'a'), os.path.join(_test_dir_fixture, 'link'))
+    for i in range(2000): open(os.path.join(_test_dir_fixture, 'e', f'{i:0>200}'), 'w').close()
+    counts = [0, 0]
+    entries = linux.scan_dir(os.path.join(_test_dir_fixture, 'e'), counts=counts)
+    assert sorted(entries) == sorted(scan_dir(os.path.join(_test_dir_fixture, 'e')))
+    assert counts[0] == len(entries) == 2001 and counts[1] > 2
+    assert ('link', False) in [e[:2] for e in linux.scan_dir(_test_dir_fixture)]
+
+    stats = Stats()
+    tree = CompactTree.from_dir(_test_dir_fixture, 2, stats=stats, backend='statx')
+    assert list(map(repr, tree.iter_nodes(lambda _: True))) == list(map(repr, CompactTree.from_dir(_test_dir_fixture).iter_nodes(lambda _: True)))
+    assert stats.counters['stat_calls'] == stats.counters['entries_listed']
+    assert stats.to_dict()['rates']['stat_calls_per_entry'] == 1
+    errors = []
+    assert linux.scan_dir(os.path.join(_test_dir_fixture, 'missing'), errors.append) == []
+    assert len(errors) == 1 and isinstance(errors[0], FileNotFoundError)